@@ -13,33 +13,226 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Loads experimental data (x, y sequences) from data file."""
+"""
+Loads experimental data (x, y sequences) from data file.
+
+The data in bdata.csv is converted once into a binary cache file, bdata.dat,
+which holds a small header followed by the participant numbers, the offsets of
+each participant's trials, and the x and y sequences of all participants,
+concatenated, as two int8 arrays. Participants may have different numbers of
+trials. The CSV file is read twice in chunks, first to count the trials of
+each participant and then to copy them to the cache, so memory use does not
+grow with the number of trials. The cache is memory-mapped, so loading it is
+almost instantaneous, and it is rebuilt automatically when bdata.csv changes.
+The data is loaded on first access to any of the module attributes below, so
+importing this module is cheap, and bdata is only built when it is accessed.
+
+Module attributes:
+bdata -- list of (x, y) sequences, one per participant, as read-only int8
+    views of X and Y
+X, Y -- read-only int8 arrays of the outcomes and responses of all
+    participants, memory-mapped from the cache
+OFFSETS -- the trials of participant i are X[OFFSETS[i]:OFFSETS[i + 1]]
+PARTICIPANTS -- participant numbers, in the order of the data
+N -- number of participants
+NTRIALS -- maximum number of trials of a participant
+"""
 
 import os
-import pickle
-import pandas as pd
-
-def load_behavioral_data():
-    """Loads the behavioral data and saves it in a more convenient format."""
-    if not os.path.exists('bdata.bin'):
-        dtf = pd.read_csv('bdata.csv')
-        bdata = []
-        for part in dtf.participant.unique():
-            x, y = [], []
-            for _, row in dtf[dtf.participant == part].iterrows():
-                x.append(row.x)
-                y.append(row.y)
-            bdata.append((x, y))
-            del x
-            del y
-        del dtf
-        with open('bdata.bin', 'wb') as outf:
-            pickle.dump(bdata, outf)
+import hashlib
+import numpy as np
+
+CSV_FN = 'bdata.csv'
+CACHE_FN = 'bdata.dat'
+MAGIC = b'MPLBDATA'
+VERSION = 2
+CHUNK_ROWS = 1000000 # Number of CSV rows read at a time
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('n', '<u4'),
+    ('total', '<u8'),
+    ('csv_size', '<u8'),
+    ('csv_mtime', '<i8'),
+    ('csv_hash', 'u1', (32,)),
+])
+
+def _csv_hash(csv_fn):
+    """SHA-256 digest of a file."""
+    sha = hashlib.sha256()
+    with open(csv_fn, 'rb') as inf:
+        for block in iter(lambda: inf.read(1 << 20), b''):
+            sha.update(block)
+    return np.frombuffer(sha.digest(), np.uint8)
+
+def _read_header(cache_fn):
+    """Reads the header of the cache file, or returns None if it is invalid."""
+    try:
+        header = np.fromfile(cache_fn, HEADER, 1)
+    except (OSError, ValueError):
+        return None
+    if len(header) != 1 or header['magic'][0] != MAGIC or\
+            header['version'][0] != VERSION:
+        return None
+    return header
+
+def _read_chunks(csv_fn):
+    """Reads the CSV file in chunks of CHUNK_ROWS rows."""
+    import pandas as pd
+    return pd.read_csv(
+        csv_fn, usecols=['participant', 'x', 'y'], chunksize=CHUNK_ROWS,
+        dtype={'participant': np.int64, 'x': np.int8, 'y': np.int8})
+
+def _codes(participants, codes):
+    """
+    Codes of the participant numbers of a chunk.
+
+    codes maps participant numbers to codes; participants not in it get new
+    codes in order of first appearance.
+    """
+    import pandas as pd
+    chunk_codes, uniques = pd.factorize(participants)
+    for participant in uniques:
+        codes.setdefault(participant, len(codes))
+    return np.array([codes[p] for p in uniques], np.int64)[chunk_codes]
+
+def _build_cache(csv_fn, cache_fn):
+    """Groups the CSV data by participant and writes the cache file."""
+    stat = os.stat(csv_fn)
+    # First pass: number of trials per participant, numbered in order of
+    # first appearance
+    codes = {}
+    counts = np.zeros(0, np.int64)
+    for chunk in _read_chunks(csv_fn):
+        chunk_counts = np.bincount(
+            _codes(chunk['participant'].values, codes), minlength=len(codes))
+        counts = np.concatenate(
+            [counts, np.zeros(len(codes) - len(counts), np.int64)])
+        counts += chunk_counts
+    n, total = len(codes), int(counts.sum())
+    participants = np.fromiter(codes, np.int64, n)
+    offsets = np.zeros(n + 1, np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    header = np.zeros(1, HEADER)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['n'] = n
+    header['total'] = total
+    header['csv_size'] = stat.st_size
+    header['csv_mtime'] = stat.st_mtime_ns
+    header['csv_hash'] = _csv_hash(csv_fn)
+    tmp_fn = '{}.{}.tmp'.format(cache_fn, os.getpid())
+    with open(tmp_fn, 'wb') as outf:
+        outf.write(header.tobytes())
+        outf.write(participants.astype('<i8').tobytes())
+        outf.write(offsets.astype('<i8').tobytes())
+        data_offset = outf.tell()
+        outf.truncate(data_offset + 2*total)
+    # Second pass: copy each chunk's trials after the trials of the same
+    # participants in the previous chunks, keeping the order in the file
+    if total:
+        X = np.memmap(tmp_fn, np.int8, 'r+', data_offset, (total,))
+        Y = np.memmap(tmp_fn, np.int8, 'r+', data_offset + total, (total,))
+        ends = offsets[:-1].copy()
+        for chunk in _read_chunks(csv_fn):
+            chunk_codes = _codes(chunk['participant'].values, codes)
+            order = np.argsort(chunk_codes, kind='stable')
+            sorted_codes = chunk_codes[order]
+            chunk_counts = np.bincount(chunk_codes, minlength=n)
+            starts = np.cumsum(chunk_counts) - chunk_counts
+            dest = ends[sorted_codes] + np.arange(len(order)) -\
+                starts[sorted_codes]
+            X[dest] = chunk['x'].values[order]
+            Y[dest] = chunk['y'].values[order]
+            ends += chunk_counts
+        X.flush()
+        Y.flush()
+        del X, Y
+    os.replace(tmp_fn, cache_fn)
+
+def _cache_is_current(header, csv_fn, cache_fn):
+    """
+    Checks whether the cache header matches the CSV file.
+
+    The size and modification time are checked first. If only the time
+    differs, the CSV hash decides, and the cache is marked current again.
+    """
+    stat = os.stat(csv_fn)
+    if header['csv_size'][0] != stat.st_size:
+        return False
+    if header['csv_mtime'][0] == stat.st_mtime_ns:
+        return True
+    if not np.array_equal(header['csv_hash'][0], _csv_hash(csv_fn)):
+        return False
+    header['csv_mtime'] = stat.st_mtime_ns
+    with open(cache_fn, 'r+b') as outf:
+        outf.write(header.tobytes())
+    return True
+
+def load_behavioral_data(csv_fn=CSV_FN, cache_fn=CACHE_FN):
+    """
+    Loads the behavioral data from the cache, rebuilding it if needed.
+
+    Returns the participant numbers, the offsets of each participant's
+    trials, and the arrays X and Y.
+    """
+    header = _read_header(cache_fn)
+    if header is None or not _cache_is_current(header, csv_fn, cache_fn):
+        _build_cache(csv_fn, cache_fn)
+        header = _read_header(cache_fn)
+    n, total = int(header['n'][0]), int(header['total'][0])
+    offset = HEADER.itemsize
+    with open(cache_fn, 'rb') as inf:
+        inf.seek(offset)
+        participants = np.fromfile(inf, '<i8', n)
+        offsets = np.fromfile(inf, '<i8', n + 1)
+    offset += participants.nbytes + offsets.nbytes
+    if total == 0:
+        X = Y = np.zeros(0, np.int8)
     else:
-        with open('bdata.bin', 'rb') as inf:
-            bdata = pickle.load(inf)
-    return bdata
+        X = np.memmap(cache_fn, np.int8, 'r', offset, (total,))
+        Y = np.memmap(cache_fn, np.int8, 'r', offset + total, (total,))
+    return participants, offsets, X, Y
+
+def stan_data(data, suffix=''):
+    """
+    Stan data for a list of (x, y) sequences.
+
+    Returns a dictionary with the number of participants (N), the number of
+    trials of each participant (T), the total number of trials (TT), and the
+    concatenated sequences (x, y). suffix is appended to the keys.
+    """
+    lengths = [len(x) for x, _ in data]
+    dat = {
+        'N': len(data),
+        'T': lengths,
+        'TT': sum(lengths),
+        'x': np.concatenate([x for x, _ in data]).astype(int) if data else [],
+        'y': np.concatenate([y for _, y in data]).astype(int) if data else [],
+    }
+    return {key + suffix: value for key, value in dat.items()}
+
+_ARRAYS = ('PARTICIPANTS', 'OFFSETS', 'X', 'Y')
+_DATA_ATTRS = _ARRAYS + ('bdata', 'N', 'NTRIALS')
+
+def _participant_data():
+    """The (x, y) views of each participant, for bdata."""
+    return [
+        (X[ini:end], Y[ini:end])
+        for ini, end in zip(OFFSETS[:-1].tolist(), OFFSETS[1:].tolist())]
 
-bdata = load_behavioral_data()
-N = len(bdata) # Number of participants
-NTRIALS = len(bdata[0][0]) # Number of trials
+def __getattr__(name):
+    """Loads a data attribute on first access."""
+    if name not in _DATA_ATTRS:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+    if 'X' not in globals():
+        globals().update(zip(_ARRAYS, load_behavioral_data()))
+    if name == 'bdata':
+        globals()['bdata'] = _participant_data()
+    elif name == 'N':
+        globals()['N'] = len(PARTICIPANTS) # Number of participants
+    elif name == 'NTRIALS':
+        # Maximum number of trials
+        globals()['NTRIALS'] = int(np.max(np.diff(OFFSETS), initial=0))
+    return globals()[name]
@@ -17,15 +17,18 @@
 
 import sys
 import os
-import random
 import numpy as np
-import pandas as pd
-from scipy.stats import multivariate_normal, chi2
-from scipy.special import expit
-from scipy.misc import logsumexp
+from scipy.special import expit, logsumexp
 from mpl_stan import SFN, KMAX
-from bdata import bdata, NTRIALS
-from mpl import mpl_logl
+import bdata as _bdata
+from mpl_backends import mpl_logl_allk_batch
+from sample_store import (
+    read_meta, append_samples, load_samples, ingest_csv, locked)
+from sample_arrays import (
+    param_array, subject_params, iter_hyperparams, HyperParams)
+
+SAMPLES_DIR = 'mpl_samples_all'
+OLD_SAMPLES_FN = 'mpl_samples_all.csv'
 
 def get_sample_files():
     """Returns Stan sample files."""
@@ -37,98 +40,166 @@ def get_sample_files():
             fns.append(filename)
     return fns
 
-def get_samples():
-    """Get all MPL samples as a Pandas dataframe."""
-    fnall = 'mpl_samples_all.csv'
-    if not os.path.exists(fnall):
-        sample_files = get_sample_files()
-        for i, filename in enumerate(sample_files):
-            warmup = int(filename[:-4].split('_')[2])
-            assert warmup > 0
-            samples = pd.read_csv(filename, comment='#')
-            print('Loading {} samples from file {} of {} ...'.format(
-                len(samples), i + 1, len(sample_files)))
+HYPERPARAMS = ('probk', 'mu', 'sigma', 'scale', 'nu')
+THETA_MAX = 1e6
+
+def get_warmup(filename):
+    """Returns the number of warmup draws in a Stan sample file."""
+    warmup = int(filename[:-4].split('_')[2])
+    assert warmup > 0
+    return warmup
+
+def update_samples():
+    """
+    Appends the new draws in the Stan sample files to the sample store.
+
+    Files that are still being written can be read as often as needed; only
+    the draws written since the last call are read.
+    """
+    sample_files = get_sample_files()
+    if not sample_files and read_meta(SAMPLES_DIR) is None:
+        raise FileNotFoundError('No MPL sample files found')
+    for i, filename in enumerate(sample_files):
+        appended = ingest_csv(SAMPLES_DIR, filename, get_warmup(filename))
+        if appended:
+            print('Loaded {} samples from file {} of {} ...'.format(
+                appended, i + 1, len(sample_files)))
             sys.stdout.flush()
-            samples = samples.iloc[warmup:]
-            if i == 0:
-                all_df = samples
-            else:
-                all_df = pd.concat((all_df, samples), ignore_index=True)
-            del samples
-        all_df.to_csv(fnall)
-        return all_df
-    else:
-        samples = pd.read_csv(fnall)
-        return samples
+
+def get_samples(prefixes=None):
+    """
+    Get MPL samples as a Pandas dataframe.
+
+    The samples are read from the Stan sample files into a sample store (see
+    sample_store.py), from which they are loaded. prefixes are the names of
+    the parameters to load, e.g. HYPERPARAMS (default: all parameters).
+    """
+    with locked(SAMPLES_DIR):
+        meta = read_meta(SAMPLES_DIR)
+        if meta is None and os.path.exists(OLD_SAMPLES_FN):
+            # Convert the samples saved by previous versions, which already
+            # include the draws in the sample files
+            import pandas as pd
+            tmp_dir = '{}.{}.tmp'.format(SAMPLES_DIR, os.getpid())
+            append_samples(tmp_dir, pd.read_csv(OLD_SAMPLES_FN, index_col=0))
+            os.replace(tmp_dir, SAMPLES_DIR)
+            os.remove(tmp_dir + '.lock')
+            meta = read_meta(SAMPLES_DIR)
+    if meta is None or 'sources' in meta:
+        update_samples()
+    return load_samples(SAMPLES_DIR, prefixes)
 
 def get_ks_hparams(samples):
     """Return k hyperparameters from samples as a list of Pandas series."""
-    probk = [[] for k in range(KMAX+1)]
-    for _, sample in samples.iterrows():
-        for k in range(KMAX+1):
-            probk[k].append(sample['probk.{}'.format(k + 1)])
-    return [pd.Series(p) for p in probk]
-
-def get_k(probsk):
-    """Get random k from a list of probabilities."""
-    prob = random.random()
-    total_prob = 0
-    for k, probk in enumerate(probsk):
-        total_prob += probk
-        if prob < total_prob:
-            return k
-    return len(probsk) - 1
+    import pandas as pd
+    probk = param_array(samples, 'probk', (KMAX + 1,))
+    return [pd.Series(p) for p in probk.T]
+
+def k_table(probk):
+    """
+    Cumulative table for sampling k with sample_k.
+
+    probk is an S x (KMAX + 1) array of probabilities. Row s of the table holds
+    s plus the cumulative probabilities of the draw s, so that the rows are
+    in increasing order and all of them can be searched at once.
+    """
+    cumprobk = np.cumsum(probk, axis=1)
+    cumprobk /= cumprobk[:, -1:]
+    return cumprobk + np.arange(len(cumprobk))[:, None]
+
+def sample_k(table, size=1, rng=np.random):
+    """
+    Random ks for S draws by inverse CDF.
+
+    Keyword parameters:
+    table -- table made by k_table
+    size -- number of ks per draw (default: 1)
+    rng -- NumPy random generator (default: numpy.random)
+
+    Returns an S x size array.
+    """
+    S, nk = table.shape
+    offsets = np.arange(S)[:, None]
+    index = np.searchsorted(
+        table.ravel(), rng.random((S, size)) + offsets, side='right')
+    return np.minimum(index - offsets*nk, nk - 1)
 
 def get_subject_meank(samples, part_num):
     """Calcules a participant's mean k from samples and participant number."""
-    x, y = bdata[part_num]
-    probsk = [0 for k in range(KMAX + 1)]
-    mean_k = 0
-    for _, sample in samples.iterrows():
-        A = sample['A.{}'.format(part_num + 1)]
-        rho = sample['rho.{}'.format(part_num + 1)]
-        theta = sample['theta.{}'.format(part_num + 1)]
-        for k in range(KMAX + 1):
-            probsk[k] = np.log(sample['probk.{}'.format(k + 1)]) +\
-                mpl_logl(x, y, 0, NTRIALS, k, A, rho, theta)
-        sum_probsk_log = logsumexp(probsk)
-        mean_k += sum(
-            [k*np.exp(p - sum_probsk_log) for k, p in enumerate(probsk)])
-    return mean_k / len(samples)
+    x, y = _bdata.bdata[part_num]
+    A, rho, theta = (p[:, 0] for p in subject_params(samples, [part_num]))
+    lls = mpl_logl_allk_batch(
+        [x], [y], KMAX, A, rho, theta, 0, np.zeros(len(A), int))
+    probk = param_array(samples, 'probk', (KMAX + 1,))
+    probsk = np.log(probk) + lls
+    probsk -= logsumexp(probsk, axis=1, keepdims=True)
+    return np.mean(np.exp(probsk).dot(np.arange(KMAX + 1)))
+
+def multivariate_t_batch(nu, mu, sigma, size=1, rng=np.random):
+    """
+    Random draws from several multivariate t distributions.
+
+    Keyword parameters:
+    nu -- S degrees of freedom
+    mu -- S x d locations
+    sigma -- S x d x d scale matrices
+    size -- number of draws from each distribution (default: 1)
+    rng -- NumPy random generator (default: numpy.random)
+
+    Returns an S x size x d array.
+    """
+    nu, mu = np.asarray(nu, float), np.asarray(mu, float)
+    S, d = mu.shape
+    L = np.linalg.cholesky(sigma)
+    Y = np.einsum('sij,smj->smi', L, rng.standard_normal((S, size, d)))
+    U = rng.chisquare(nu[:, None], (S, size))
+    return mu[:, None, :] + Y*np.sqrt(nu[:, None]/U)[:, :, None]
 
 def multivariate_t(nu, mu, sigma):
     """
-    Density of the multivariate t distribution with nu degress of freedom.
+    Random draw from the multivariate t distribution.
 
     Keyword parameters:
     nu -- degress of fredom
     mu -- location
     sigma -- scale
     """
-    d = len(mu)
-    Y = multivariate_normal.rvs(mean=np.zeros(d), cov=sigma)
-    U = chi2.rvs(nu)
-    return mu + Y*np.sqrt(nu/U)
+    return multivariate_t_batch([nu], [mu], [sigma])[0, 0]
+
+def random_params(hparams, size=1, rng=np.random):
+    """
+    Get random MPL parameters from hyperparameter draws.
+
+    Keyword parameters:
+    hparams -- HyperParams of S draws (see sample_arrays.hyperparams)
+    size -- number of parameter sets per draw (default: 1)
+    rng -- NumPy random generator (default: numpy.random)
+
+    Returns the arrays k, A, rho, theta, each S x size.
+    """
+    k = sample_k(k_table(hparams.probk), size, rng)
+    params = multivariate_t_batch(
+        hparams.nu, hparams.mu, hparams.sigma, size, rng)
+    A, rho = expit(params[:, :, 0]), expit(params[:, :, 1])
+    with np.errstate(over='ignore'):
+        # To avoid numeric errors. This is a huge theta anyway.
+        theta = np.minimum(np.exp(params[:, :, 2]), THETA_MAX)
+    return k, A, rho, theta
 
-def get_random_params(sample, size=1):
+def get_random_params(sample, size=1, rng=np.random):
     """
     Get random MPL parameters from a sample.
     
     Keyword parameters:
-    sample -- MPL sample
+    sample -- MPL sample, as a HyperParams tuple of a single draw (see
+        sample_arrays.iter_hyperparams) or a row of the samples dataframe
     size -- number of parameter sets to return (default: 1).
+    rng -- NumPy random generator (default: numpy.random)
 
     Returns a generator of (k, A, rho, theta) tuples.
     """
-    probsk = [float(sample['probk.{}'.format(k + 1)]) for k in range(KMAX + 1)]
-    mu = [float(sample['mu.{}'.format(i)]) for i in range(1, 4)]
-    nu = float(sample['nu'])
-    sigma = [[float(sample['sigma.{}.{}'.format(i, j)]) for j in range(1, 4)]\
-        for i in range(1, 4)]
-    for _ in range(size):
-        k = get_k(probsk)
-        A, rho, theta = multivariate_t(nu, mu, sigma)
-        A, rho, theta = expit(A), expit(rho), np.exp(theta)
-        if theta > 1e6: # To avoid numeric errors. This is a huge theta anyway.
-            theta = 1e6
-        yield k, A, rho, theta
+    if not isinstance(sample, HyperParams):
+        sample = next(iter_hyperparams(sample))
+    hparams = HyperParams(*(np.asarray(a)[None] for a in sample))
+    k, A, rho, theta = random_params(hparams, size, rng)
+    yield from zip(k[0], A[0], rho[0], theta[0])
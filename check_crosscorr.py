@@ -15,38 +15,46 @@
 
 """Calculate cross-correlation of data and compare with predicted values."""
 
-import random
+import argparse
 import numpy as np
 import pandas as pd
-from mpl import mpl
-from bfit_samples import get_samples, get_random_params
+from mpl_backends import mpl
+from bfit_samples import get_samples, HYPERPARAMS, get_random_params
+from sample_arrays import iter_hyperparams
 from bdata import bdata, N
 from bayesian import hpd
+from seeding import add_seed_argument, root_seed, generator
 
 def cross_correlation(x, y):
     """Calculates the cross-correlation of the sequences x, y."""
+    x, y = np.asarray(x, int), np.asarray(y, int)
     return np.mean([(2*xx - 1)*(2*yy - 1) for xx, yy in zip(x[-101:-1], y[-100:])])
 
-def exp_cross_correlation(samples):
+def exp_cross_correlation(samples, rng):
     """Calculates the expected cross-correlation from MPL samples."""
     ccs = []
     REPS = 100000
-    for _, s in samples.sample(REPS).iterrows():
+    for s in iter_hyperparams(samples.sample(REPS, random_state=rng)):
         c = np.mean(
-            [cross_correlation(x, [int(random.random() < p1) for p1 in mpl(x, k, A, rho, t)])\
-            for (x, _), (k, A, rho, t) in zip(bdata, get_random_params(s, N))])
+            [cross_correlation(x, rng.random(len(x)) < mpl(x, k, A, rho, t))\
+            for (x, _), (k, A, rho, t) in zip(
+                bdata, get_random_params(s, N, rng))])
         ccs.append(c)
     return pd.Series(ccs)
 
 def main():
     """Prints observed and expected cross-correlation values."""
+    parser = argparse.ArgumentParser(
+        description='Compares the observed and expected cross-correlation.')
+    add_seed_argument(parser)
+    rng = generator(root_seed(parser.parse_args().seed))
     obs_cc = []
     for x, y in bdata:
         obs_cc.append(cross_correlation(x, y))
     mean_cc = np.mean(obs_cc)
     print('Observed (mean, stdev):', mean_cc, np.std(obs_cc))
-    samples = get_samples()
-    ecc = exp_cross_correlation(samples)
+    samples = get_samples(HYPERPARAMS)
+    ecc = exp_cross_correlation(samples, rng)
     print(
         'Expected (mean, credible inteval, HPDI, prob[expected < observed]):',
         ecc.mean(), (ecc.quantile(0.025), ecc.quantile(0.975)),
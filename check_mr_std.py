@@ -16,28 +16,37 @@
 """Check stdev of observed mean response with regard to MPL prediction."""
 
 import sys
+import argparse
 import numpy as np
-from bfit_samples import get_samples, get_random_params
+from bfit_samples import get_samples, HYPERPARAMS, get_random_params
+from sample_arrays import iter_hyperparams
 from bdata import N, bdata
 import pandas as pd
 from predictive_mean_resp import get_mpl_mr
 from bayesian import hpd
+from seeding import add_seed_argument, root_seed, generator
 
 def main():
     """Prints observed and predicted stdev of mean response."""
-    samples = get_samples()
+    parser = argparse.ArgumentParser(
+        description='Compares the observed and predicted stdev of the mean '
+        'response.')
+    add_seed_argument(parser)
+    rng = generator(root_seed(parser.parse_args().seed))
+    samples = get_samples(HYPERPARAMS)
 
     # Predicted stdev of mean response for 84 new participants
     stds = []
 
-    for i, (_, sample) in enumerate(samples.iterrows()):
+    for i, sample in enumerate(iter_hyperparams(samples)):
         print('Calculating predicted stdev of mean response...')
         if i % 100 == 0:
             print('Rep {} of {}...'.format(i + 1, len(samples)))
         sys.stdout.flush()
         mrs = []
-        for (x, _), (k, A, rho, t) in zip(bdata, get_random_params(sample, N)):
-            mrs.append(get_mpl_mr(x, k, A, rho, t))
+        for (x, _), (k, A, rho, t) in zip(
+                bdata, get_random_params(sample, N, rng)):
+            mrs.append(get_mpl_mr(x, k, A, rho, t, rng))
         stds.append(np.std(mrs, ddof=1))
     stds = pd.Series(stds)
 
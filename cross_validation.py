@@ -16,22 +16,96 @@
 """
 Runs cross-validation for the PVL, MPL, and WSLS models.
 To get the LPPD, run lppd_models.py
+To fit and score all the folds of several models and seeds, run cv_grid.py
 """
 
 import sys
 import random
 import os
 import argparse
-from bdata import N, bdata, NTRIALS
+import bdata
 from mpl_stan import KMAX, get_stan_model
 
 
 K = 12
-assert N % K == 0
 SFN = 'cv-{}-{}-{:02d}.csv'
 PVL_WARMUP = 1000
 MPL_WARMUP = 10000
 WSLS_WARMUP = 2500
+MODELS = {
+    'PVL': ('model-pvl.stan', PVL_WARMUP),
+    'MPL': ('model-mpl.stan', MPL_WARMUP),
+    'WSLS': ('model-wsls.stan', WSLS_WARMUP),
+}
+
+_stan_models = {}
+
+def partition(seed):
+    """
+    Partitions the participants into K sets for cross-validation.
+
+    The participants are shuffled with a random.Random seeded with seed, so
+    the global random state is left untouched.
+    Returns a list of K lists of participant numbers (indices of bdata).
+    """
+    assert bdata.N % K == 0
+    subjs = list(range(bdata.N))
+    random.Random(seed).shuffle(subjs)
+    set_len = bdata.N // K
+    return [subjs[i*set_len:(i + 1)*set_len] for i in range(K)]
+
+def load_model(model):
+    """
+    Returns the compiled Stan model of a model (PVL, MPL, or WSLS).
+
+    Each model is loaded only once per process.
+    """
+    if model not in _stan_models:
+        _stan_models[model] = get_stan_model(MODELS[model][0])
+    return _stan_models[model]
+
+def fold_sample_file(model, exc_set, seed):
+    """Returns the sample file of a fold."""
+    return os.path.join(os.getcwd(), SFN.format(seed, model.lower(), exc_set))
+
+def fit_fold(model, exc_set, seed):
+    """
+    Fits a model to the participants not in a set, unless already done.
+
+    Stan writes the samples to a temporary file, which is renamed to the
+    fold's sample file when sampling is finished, so an interrupted fit is
+    not taken as done.
+
+    Keyword parameters:
+    model -- PVL, MPL, or WSLS
+    exc_set -- participant set to exclude (0 to K - 1)
+    seed -- seed for data set partition
+
+    Returns True if the model was fitted, False if the sample file exists.
+    """
+    sfn = fold_sample_file(model, exc_set, seed)
+    if os.path.exists(sfn):
+        return False
+    sets = partition(seed)
+    excluded = [bdata.bdata[subj] for subj in sets[exc_set]]
+    included = [
+        bdata.bdata[subj]
+        for i, subjs in enumerate(sets) if i != exc_set for subj in subjs]
+    assert len(excluded) + len(included) == bdata.N
+    model_dat = bdata.stan_data(included)
+    if model == 'MPL':
+        model_dat['kmaxp1'] = KMAX + 1
+    elif model == 'WSLS':
+        model_dat.update(bdata.stan_data(excluded, '_'))
+    warmup = MODELS[model][1]
+    tmp_fn = sfn[:-4] + '.tmp.csv'
+    fit = load_model(model).sampling(
+        data=model_dat, iter=2*warmup, warmup=warmup, chains=1, n_jobs=1,
+        sample_file=tmp_fn)
+    with open(sfn[:-3] + 'txt', 'w') as outf:
+        outf.write(str(fit))
+    os.replace(tmp_fn, sfn)
+    return True
 
 def main():
     """Performs cross-validation of the model."""
@@ -48,45 +122,7 @@ def main():
     if model not in ('PVL', 'MPL', 'WSLS'):
         print('Invalid model.')
         sys.exit(0)
-    random.seed(args.seed)
-    random.shuffle(bdata)
-    exc_set = args.set
-    set_len = N // K
-    excluded = bdata[exc_set*set_len:(exc_set + 1)*set_len]
-    included = bdata[:exc_set*set_len] + bdata[(exc_set + 1)*set_len:]
-    assert len(excluded) + len(included) == len(bdata)
-
-    sfn = SFN.format(args.seed, model.lower(), exc_set)
-    sfn = os.path.join(os.getcwd(), sfn)
-    if not os.path.exists(sfn):
-        model_dat = {
-            'T': NTRIALS,
-            'N': len(included),
-            'x': [x for x, y in included],
-            'y': [y for x, y in included],
-        }
-        if model == 'PVL':
-            stan_model = get_stan_model('model-pvl.stan', 'model-pvl')
-            iters = 2*PVL_WARMUP
-            warmup = PVL_WARMUP
-        elif model == 'MPL':
-            stan_model = get_stan_model('model-mpl.stan', 'model-mpl')
-            iters = 2*MPL_WARMUP
-            warmup = MPL_WARMUP
-            model_dat['kmaxp1'] = KMAX + 1
-        else:
-            assert model == 'WSLS'
-            stan_model = get_stan_model('model-wsls.stan', 'model-wsls')
-            iters = 2*WSLS_WARMUP
-            warmup = WSLS_WARMUP
-            model_dat['N_'] = len(excluded)
-            model_dat['x_'] = [x for x, y in excluded]
-            model_dat['y_'] = [y for x, y in excluded]
-
-        fit = stan_model.sampling(
-            data=model_dat, iter=iters, warmup=warmup, chains=1, sample_file=sfn)
-        with open(sfn[:-3] + 'txt', 'w') as outf:
-            outf.write(str(fit))
+    fit_fold(model, args.set, args.seed)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,157 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs cross-validation for several models and seeds on a pool of processes.
+
+Each fold (model, seed, excluded set) is fitted as in cross_validation.py,
+unless its sample file already exists, and scored as in lppd_models.py as
+soon as it is finished. The scores of the folds are appended to a CSV file,
+and folds already in it are not run again, so an interrupted run resumes where
+it stopped. The CV score of each model and seed is printed when all its folds
+are done.
+Run:
+$ python3 cv_grid.py SEED [SEED ...] [--models PVL MPL WSLS] [--processes P]
+    [--memory GB]
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+from cross_validation import K, MODELS, fit_fold, load_model
+from lppd_models import fold_lppd
+
+CV_SCORES_FN = 'cv_scores.csv'
+MEMORY_PER_FIT = 2 # Default memory per fit in GB
+
+def max_processes(memory):
+    """
+    Number of folds that can run at once.
+
+    Limited by the number of CPUs and the available memory divided by the
+    memory needed per fit (memory, in GB).
+    """
+    processes = os.cpu_count() or 1
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return processes
+    return max(1, min(processes, int(available/(memory*2**30))))
+
+def read_scores(scores_fn):
+    """
+    Reads the lppds in a scores file.
+
+    Returns a dictionary of lppds by (model, seed, fold). Incomplete lines,
+    left by an interrupted run, are ignored.
+    """
+    scores = {}
+    try:
+        with open(scores_fn) as inf:
+            next(inf, None) # Header
+            for line in inf:
+                fields = line.split(',')
+                if not line.endswith('\n') or len(fields) != 4:
+                    continue
+                try:
+                    scores[fields[0], int(fields[1]), int(fields[2])] = float(
+                        fields[3])
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return scores
+
+_N_THREADS = 0
+
+def _init_worker(n_threads):
+    """Sets the number of threads used to score the folds in a worker."""
+    global _N_THREADS
+    _N_THREADS = n_threads
+
+def run_fold(task):
+    """Fits a fold if needed, returns (task, whether it was fitted, lppd)."""
+    model, seed, cvgroup = task
+    fitted = fit_fold(model, cvgroup, seed)
+    return task, fitted, fold_lppd(model, seed, cvgroup, n_threads=_N_THREADS)
+
+def main():
+    """Fits and scores all folds of the selected models and seeds."""
+    parser = argparse.ArgumentParser(
+        description='Runs cross validation for several models and seeds.')
+    parser.add_argument(
+        'seeds', help='seeds for data set partition', type=int, nargs='+')
+    parser.add_argument(
+        '--models', help='models (default: PVL MPL WSLS)', nargs='+',
+        choices=sorted(MODELS), default=['PVL', 'MPL', 'WSLS'])
+    parser.add_argument(
+        '--processes', help='number of folds run at once (default: limited '
+        'by the CPUs and memory)', type=int, default=None)
+    parser.add_argument(
+        '--memory', help='memory needed per fit in GB (default {})'.format(
+            MEMORY_PER_FIT), type=float, default=MEMORY_PER_FIT)
+    parser.add_argument(
+        '--output', help='scores file (default {})'.format(CV_SCORES_FN),
+        type=str, default=CV_SCORES_FN)
+    args = parser.parse_args()
+    # Compile the models before starting the workers, which load them
+    for model in args.models:
+        load_model(model)
+    tasks = [
+        (model, seed, cvgroup)
+        for seed in args.seeds for model in args.models
+        for cvgroup in range(K)]
+    scores = read_scores(args.output)
+    lppds = {}
+
+    def scored(model, seed, cvgroup, lppd):
+        folds = lppds.setdefault((model, seed), {})
+        folds[cvgroup] = lppd
+        if len(folds) == K:
+            print('{} seed {}: CV score {}'.format(
+                model, seed, -2*sum(folds[i] for i in range(K))))
+        sys.stdout.flush()
+
+    for task in tasks:
+        if task in scores:
+            print('{} seed {} fold {}: lppd {} (already scored)'.format(
+                *task, scores[task]))
+            scored(*task, scores[task])
+    tasks = [task for task in tasks if task not in scores]
+    processes = args.processes or max_processes(args.memory)
+    n_threads = max(1, (os.cpu_count() or 1)//processes)
+    with open(args.output, 'a') as outf, \
+            multiprocessing.Pool(
+                processes, _init_worker, (n_threads,)) as pool:
+        if outf.tell() == 0:
+            outf.write('model,seed,fold,lppd\n')
+        else:
+            # Ends a line left incomplete by an interrupted run
+            with open(args.output, 'rb') as inf:
+                inf.seek(-1, os.SEEK_END)
+                if inf.read(1) != b'\n':
+                    outf.write('\n')
+        for task, fitted, lppd in pool.imap_unordered(run_fold, tasks):
+            model, seed, cvgroup = task
+            outf.write('{},{},{},{}\n'.format(model, seed, cvgroup, lppd))
+            outf.flush()
+            print('{} seed {} fold {}{}: lppd {}'.format(
+                model, seed, cvgroup, '' if fitted else ' (already fitted)',
+                lppd))
+            scored(model, seed, cvgroup, lppd)
+
+if __name__ == '__main__':
+    main()
@@ -15,10 +15,11 @@
 
 """Simulates MPL agents searching for patterns."""
 
-import random
 import pickle
+import argparse
 import numpy as np
-from mpl import mpl
+from mpl_backends import simulate_batch
+from seeding import add_seed_argument, root_seed, native_seed
 
 PATTERNS = [
     '01',
@@ -34,16 +35,19 @@ KMAXP1 = 4
 
 def main():
     """Runs pattern search simulations."""
+    parser = argparse.ArgumentParser(
+        description='Simulates MPL agents searching for patterns.')
+    add_seed_argument(parser)
+    seed = root_seed(parser.parse_args().seed)
     with open(RESULTS_FN, 'wb') as outf:
-        for pat in PATTERNS:
+        for p, pat in enumerate(PATTERNS):
             x = [int(i) for i in pat*(300//len(pat))]
             assert len(x) == 300
+            xs = np.tile(np.array(x, np.int8), (REPS, 1))
             for k in range(KMAXP1):
-                acc = 0
-                for _ in range(REPS):
-                    y = [int(random.random() < p1) for p1 in mpl(x, k, A, RHO, THETA)]
-                    acc += np.mean([int(xx == yy) for xx, yy in zip(x[100:], y[100:])])
-                acc /= REPS
+                _, ys = simulate_batch(
+                    xs, k, A, RHO, THETA, native_seed(seed, p, k))
+                acc = np.mean(xs[:, 100:] == ys[:, 100:])
                 print(pat, k, acc)
                 pickle.dump((k, acc), outf)
 
@@ -0,0 +1,148 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fits the MPL model to each participant by maximum likelihood or MAP.
+
+The parameters are optimized on the unconstrained scale
+(logit A, logit rho, log theta) with L-BFGS-B from several random starts,
+using the analytic gradient of the log-likelihood. This is much faster than
+sampling with Stan, and the estimates can be used as Stan inits.
+Run:
+$ python3 fit_mpl_mle.py [--map SD] [--starts N] [--seed SEED] [--processes P]
+"""
+
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.special import expit
+from mpl_backends import mpl_logl_grad
+from mpl_stan import KMAX
+from seeding import generator, add_seed_argument, root_seed
+from mc_runner import add_processes_argument
+import bdata
+
+MLE_FN = 'mpl_mle.csv'
+BOUND = 15 # Bound on the unconstrained parameters, to avoid overflow
+
+def neg_log_post(u, x, y, k, prior_sd):
+    """
+    Negative log-likelihood (or log-posterior) and its gradient.
+
+    Keyword parameters:
+    u -- unconstrained parameters (logit A, logit rho, log theta)
+    x, y -- outcome and response sequences
+    k -- MPL k
+    prior_sd -- standard deviation of independent normal(0, prior_sd) priors
+        on the unconstrained parameters, or None for maximum likelihood
+    """
+    A, rho, theta = expit(u[0]), expit(u[1]), np.exp(u[2])
+    ll, _, grad = mpl_logl_grad(x, y, 0, len(x), k, A, rho, theta)
+    grad = np.array(grad)
+    if prior_sd is not None:
+        ll -= 0.5*np.sum(u**2)/prior_sd**2
+        grad -= u/prior_sd**2
+    return -ll, -grad
+
+def fit_subject(x, y, k, starts, rng, prior_sd=None):
+    """
+    Fits the MPL model with a given k from several random starts.
+
+    Returns the best optimization result.
+    """
+    best = None
+    for _ in range(starts):
+        u0 = rng.normal(0, 1.5, 3)
+        res = minimize(
+            neg_log_post, u0, args=(x, y, k, prior_sd), jac=True,
+            method='L-BFGS-B', bounds=[(-BOUND, BOUND)]*3)
+        if best is None or res.fun < best.fun:
+            best = res
+    return best
+
+def fit_participant(args):
+    """Fits all ks for one participant, returns a list of result rows."""
+    part_num, x, y, kmax, starts, seed, prior_sd = args
+    rng = generator(seed, part_num)
+    x, y = np.array(x, np.int8), np.array(y, np.int8)
+    rows = []
+    for k in range(kmax + 1):
+        res = fit_subject(x, y, k, starts, rng, prior_sd)
+        A, rho, theta = expit(res.x[0]), expit(res.x[1]), np.exp(res.x[2])
+        ll, _, _ = mpl_logl_grad(x, y, 0, len(x), k, A, rho, theta)
+        rows.append({
+            'participant': part_num,
+            'k': k,
+            'A': A,
+            'rho': rho,
+            'theta': theta,
+            'logl': ll,
+            'objective': -res.fun,
+            'converged': res.success,
+        })
+    return rows
+
+def fit_all(data, kmax=KMAX, starts=10, seed=0, prior_sd=None, processes=None):
+    """
+    Fits all participants in parallel.
+
+    Keyword parameters:
+    data -- list of (x, y) sequences, one per participant
+    kmax -- maximum k to fit
+    starts -- number of random starts per participant and k
+    seed -- root seed of the random starts (see seeding.py)
+    prior_sd -- see neg_log_post
+    processes -- number of worker processes (default: number of CPUs)
+
+    Returns a Pandas dataframe with one row per participant and k.
+    """
+    tasks = [
+        (part_num, x, y, kmax, starts, seed, prior_sd)
+        for part_num, (x, y) in enumerate(data)]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(fit_participant, tasks)
+    return pd.DataFrame([row for rows in results for row in rows])
+
+def main():
+    """Fits all participants and saves the results to a CSV file."""
+    parser = argparse.ArgumentParser(
+        description='Fits the MPL model to each participant by maximum '
+        'likelihood or MAP.')
+    parser.add_argument(
+        '--map', help='MAP with normal(0, SD) priors on the unconstrained '
+        'parameters (default: maximum likelihood)', type=float, default=None,
+        metavar='SD')
+    parser.add_argument(
+        '--kmax', help='maximum k (default {})'.format(KMAX), type=int,
+        default=KMAX)
+    parser.add_argument(
+        '--starts', help='random starts per fit (default 10)', type=int,
+        default=10)
+    add_seed_argument(parser)
+    add_processes_argument(parser)
+    parser.add_argument(
+        '--output', help='output file (default {})'.format(MLE_FN), type=str,
+        default=MLE_FN)
+    args = parser.parse_args()
+    results = fit_all(
+        bdata.bdata, args.kmax, args.starts, root_seed(args.seed), args.map,
+        args.processes)
+    results.to_csv(args.output, index=False)
+    print(results.loc[results.groupby('participant').logl.idxmax()])
+
+if __name__ == '__main__':
+    main()
@@ -16,11 +16,12 @@
 """Calculates hyperparameter estimates from MPL samples."""
 
 import collections
-from bfit_samples import get_samples, get_ks_hparams, KMAX
+from bfit_samples import get_samples, HYPERPARAMS, get_ks_hparams, KMAX
 from scipy.special import expit
-from numpy import exp
+import numpy as np
 import pandas as pd
 from bayesian import hpd
+from sample_arrays import param_array
 
 
 def f2s(*xs):
@@ -35,7 +36,7 @@ def f2s(*xs):
 
 def main():
     """Prints hyperparameter estimates."""
-    samples = get_samples()
+    samples = get_samples(HYPERPARAMS)
     kprobs = get_ks_hparams(samples)
     print('Mean, credible interval, HPDI')
     for k in range(KMAX + 1):
@@ -59,8 +60,8 @@ def main():
         f2s(q.mean(), q.quantile(0.025), q.quantile(0.975), hpd(q)))
 
     # Medians, not means!
-    A, rho, theta = expit(samples['mu.1']), expit(samples['mu.2']),\
-        exp(samples['mu.3'])
+    mu = param_array(samples, 'mu', (3,))
+    A, rho, theta = expit(mu[:, 0]), expit(mu[:, 1]), np.exp(mu[:, 2])
 
     for param, medians in zip(('A', 'rho', 'theta'), (A, rho, theta)):
         medians = pd.Series(medians)
@@ -72,15 +73,11 @@ def main():
                 hpd(medians)))
     # Correlations between parameters
     # Correlation is obtained by dividing the covariance by the product of stdev.
-    cor = []
-    for _, sample in samples.iterrows():
-        scor = []
-        for i in range(2):
-            for j in range(i + 1, 3):
-                scor.append(
-                    sample['sigma.{}.{}'.format(i + 1, j + 1)]/\
-                    (sample['scale.{}'.format(i + 1)]*sample['scale.{}'.format(j + 1)]))
-        cor.append(scor)
+    sigma = param_array(samples, 'sigma', (3, 3))
+    scale = param_array(samples, 'scale', (3,))
+    cor = np.column_stack([
+        sigma[:, i, j]/(scale[:, i]*scale[:, j])
+        for i in range(2) for j in range(i + 1, 3)])
     cols = ('corArho', 'corAtheta', 'corrhotheta')
     cor = pd.DataFrame(cor, columns=cols)
     for col in cols:
@@ -26,60 +26,142 @@ data partition.
 import os
 import sys
 import numpy as np
-import pandas as pd
-from scipy.misc import logsumexp
+from scipy.special import logsumexp
 from scipy.special import expit
-from mpl import mpl_logl
-from bfit_samples import multivariate_t, KMAX
-from bdata import N, bdata, NTRIALS
-from cross_validation import K, SFN, PVL_WARMUP, MPL_WARMUP, WSLS_WARMUP
-
-def calc_lppd(samples, modelf, subjs):
-    """Calculates a model's lppd from samples and subject numbers."""
-    if len(samples) > 1000:
-        samples = samples.sample(1000)
-    lppd = 0
-    for subjindex, subj in enumerate(subjs):
-        sample_lppds = []
-        for _, sample in samples.iterrows():
-            sample_lppds.append(modelf(sample, subj, subjindex))
-        lppd += logsumexp(sample_lppds) - np.log(len(samples))
-    return lppd
-
-def mplf(sample, subj, _):
-    """Calculates the MPL lppd for a sample and subject number in bdata."""
-    x, y = bdata[subj]
-    probk = [sample['probk.{}'.format(k + 1)] for k in range(KMAX + 1)]
-    mu = [sample['mu.{}'.format(i + 1)] for i in range(3)]
-    nu = sample['nu']
-    sigma = [[sample['sigma.{}.{}'.format(i + 1, j + 1)] for j in range(3)]\
-        for i in range(3)]
-    pks = [0 for k in range(KMAX + 1)]
-    A, rho, theta = multivariate_t(nu, mu, sigma)
-    A, rho, theta = expit(A), expit(rho), np.exp(theta)
-    if theta > 1e6:
-        theta = 1e6
-    for k in range(KMAX + 1):
-        pks[k] = np.log(probk[k]) +\
-            mpl_logl(x, y, 0, NTRIALS, k, A, rho, theta)
-    return logsumexp(pks)
-
-def pvlf(sample, subj, _):
-    """Calculates the PVL lppd for a sample and subject number in bdata."""
-    x, y = bdata[subj]
-    mu = [sample['mu.{}'.format(i + 1)] for i in range(2)]
-    nu = sample['nu']
-    sigma = [[sample['sigma.{}.{}'.format(i + 1, j + 1)] for j in range(2)]\
-        for i in range(2)]
-    A, theta = multivariate_t(nu, mu, sigma)
-    A, theta = expit(A), np.exp(theta)
-    if theta > 1e6:
-        theta = 1e6
-    return mpl_logl(x, y, 0, NTRIALS, 0, A, 1, theta)
-
-def wslsf(sample, _, subjindex):
-    """Calculates the WSLS lppd for a sample and subject number (from 0)."""
-    return sample['log_lik.{}'.format(subjindex + 1)]
+from mpl_backends import mpl_logl_batch, mpl_logl_allk_batch
+from bfit_samples import multivariate_t_batch, random_params, THETA_MAX
+import bdata
+from sample_arrays import param_array, hyperparams
+from sample_store import select_columns
+from seeding import generator
+from cross_validation import K, MODELS, partition, fold_sample_file
+
+MAX_DRAWS = 1000
+
+def calc_lppd(lls):
+    """
+    Calculates a model's lppd from log-likelihoods.
+
+    lls is an S x n array with the log-likelihood of each of n participants
+    for each of S sample draws.
+    """
+    return float(np.sum(logsumexp(lls, axis=0) - np.log(len(lls))))
+
+def subject_lls(subjs, A, rho, theta, kmax=None, n_threads=0):
+    """
+    Log-likelihoods of participants' responses for many parameter sets.
+
+    Participants with the same number of trials are evaluated in one batch.
+
+    Keyword parameters:
+    subjs -- participant numbers in bdata
+    A, rho, theta -- S x len(subjs) parameters for each draw and participant
+    kmax -- if None, the log-likelihoods for k = 0; otherwise, for k = 0..kmax
+    n_threads -- number of threads of the MPL backend (0 = all CPUs)
+
+    Returns an S x len(subjs) array, or S x len(subjs) x (kmax + 1) array.
+    """
+    S, n = A.shape
+    lls = np.empty((S, n) if kmax is None else (S, n, kmax + 1))
+    lengths = [len(bdata.bdata[subj][0]) for subj in subjs]
+    for length in set(lengths):
+        cols = [j for j in range(n) if lengths[j] == length]
+        xs = np.array([bdata.bdata[subjs[j]][0] for j in cols])
+        ys = np.array([bdata.bdata[subjs[j]][1] for j in cols])
+        rows = np.tile(np.arange(len(cols)), S)
+        params = [p[:, cols].ravel() for p in (A, rho, theta)]
+        if kmax is None:
+            lls[:, cols] = mpl_logl_batch(
+                xs, ys, np.zeros(len(rows), int), *params,
+                n_threads=n_threads, rows=rows).reshape(S, len(cols))
+        else:
+            lls[:, cols] = mpl_logl_allk_batch(
+                xs, ys, kmax, *params, n_threads=n_threads,
+                rows=rows).reshape(S, len(cols), kmax + 1)
+    return lls
+
+def mpl_lls(hparams, subjs, rng=np.random, n_threads=0):
+    """
+    MPL log-likelihoods of new participants.
+
+    For each hyperparameter draw and participant, the participant's A, rho,
+    and theta are drawn from the population distribution, and k is
+    marginalized. Returns an S x len(subjs) array.
+    """
+    _, A, rho, theta = random_params(hparams, len(subjs), rng)
+    lls = subject_lls(
+        subjs, A, rho, theta, hparams.probk.shape[1] - 1, n_threads)
+    return logsumexp(np.log(hparams.probk)[:, None, :] + lls, axis=2)
+
+def pvl_lls(hparams, subjs, rng=np.random, n_threads=0):
+    """PVL log-likelihoods of new participants (see mpl_lls)."""
+    params = multivariate_t_batch(
+        hparams.nu, hparams.mu, hparams.sigma, len(subjs), rng)
+    A = expit(params[:, :, 0])
+    with np.errstate(over='ignore'):
+        theta = np.minimum(np.exp(params[:, :, 1]), THETA_MAX)
+    return subject_lls(subjs, A, np.ones_like(A), theta, None, n_threads)
+
+def fold_lls(model, samples, subjs, rng=np.random, n_threads=0):
+    """
+    Log-likelihoods of the participants excluded from a fold.
+
+    Keyword parameters:
+    model -- PVL, MPL, or WSLS
+    samples -- the fold's samples
+    subjs -- the excluded participants' numbers in bdata
+    rng -- NumPy random generator (default: numpy.random)
+    n_threads -- see subject_lls
+
+    Returns an S x len(subjs) array.
+    """
+    if model == 'PVL':
+        return pvl_lls(hyperparams(samples, None, 2), subjs, rng, n_threads)
+    if model == 'MPL':
+        return mpl_lls(hyperparams(samples), subjs, rng, n_threads)
+    # WSLS computes the log-likelihoods in Stan
+    return param_array(samples, 'log_lik', (len(subjs),))
+
+PREFIXES = {
+    'PVL': ('mu', 'sigma', 'nu'),
+    'MPL': ('probk', 'mu', 'sigma', 'nu'),
+    'WSLS': ('log_lik',),
+}
+
+def read_fold_samples(sfn, model, warmup, rng=np.random):
+    """
+    Reads the samples of a fold needed to calculate its lppd.
+
+    Only the needed columns are read, the warmup draws are discarded, and at
+    most MAX_DRAWS random draws are returned.
+    """
+    import pandas as pd
+    samples = pd.read_csv(
+        sfn, comment='#',
+        usecols=lambda column: bool(select_columns([column], PREFIXES[model])))
+    samples = samples.iloc[warmup:]
+    if len(samples) > MAX_DRAWS:
+        samples = samples.sample(MAX_DRAWS, random_state=rng)
+    return samples
+
+def fold_lppd(model, seed, cvgroup, sets=None, n_threads=0):
+    """
+    Calculates the lppd of a cross-validation fold from its sample file.
+
+    Keyword parameters:
+    model -- PVL, MPL, or WSLS
+    seed -- seed for data set partition
+    cvgroup -- the excluded participant set (0 to K - 1)
+    sets -- partition(seed), if already calculated
+    n_threads -- see subject_lls; 1 in processes that run folds in parallel
+    """
+    if sets is None:
+        sets = partition(seed)
+    rng = generator(seed, cvgroup)
+    samples = read_fold_samples(
+        fold_sample_file(model, cvgroup, seed), model, MODELS[model][1], rng)
+    return calc_lppd(
+        fold_lls(model, samples, sets[cvgroup], rng, n_threads))
 
 def main():
     """Prints the CV score of the selected model."""
@@ -94,26 +176,14 @@ def main():
     if model not in ('PVL', 'MPL', 'WSLS'):
         print('Invalid model.')
         sys.exit(0)
+    sets = partition(args.seed)
     lppd = 0
     for cvgroup in range(K):
-        grouplen = N // K
-        excluded = list(range(cvgroup*grouplen, (cvgroup + 1)*grouplen))
-        sfn = SFN.format(args.seed, model.lower(), cvgroup)
+        sfn = fold_sample_file(model, cvgroup, args.seed)
         if not os.path.exists(sfn):
             print('Error: sample file {} does not exist'.format(sfn))
             sys.exit(0)
-        if model == 'PVL':
-            warmup = PVL_WARMUP
-            modelf = pvlf
-        elif model == 'MPL':
-            warmup = MPL_WARMUP
-            modelf = mplf
-        else:
-            warmup = WSLS_WARMUP
-            modelf = wslsf
-        samples = pd.read_csv(sfn, comment='#')
-        samples = samples.iloc[warmup:]
-        lppd += calc_lppd(samples, modelf, excluded)
+        lppd += fold_lppd(model, args.seed, cvgroup, sets)
         print(lppd)
         sys.stdout.flush()
     print(-2*lppd)
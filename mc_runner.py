@@ -0,0 +1,179 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs Monte Carlo simulations on a pool of worker processes.
+
+A simulation of reps agents is split into chunks of fixed size. A task
+function simulates the agents first to first + n - 1 of a chunk and returns
+partial sums (a NumPy array, a number, or a tuple of them). The chunk
+boundaries depend only on reps and the chunk size, and each task draws its
+random numbers from streams keyed by the chunk (see seeding.py), so the result
+is the same whatever the number of processes and the order in which the
+chunks finish. The partial sums are added in chunk order by pairwise (tree)
+reduction.
+
+Finished chunks are appended to a checkpoint file, if one is given, so an
+interrupted script resumes where it stopped when it is run again with the same
+seed. A checkpoint is only used by a run with the same identifier (which
+should include the seed), reps, and chunk size. Scripts remove their
+checkpoints with clear_checkpoints once their results are saved.
+"""
+
+import os
+import sys
+import glob
+import pickle
+import multiprocessing
+
+CHUNK = 25000 # Default number of agents per chunk
+CHECKPOINT_DIR = 'mc_checkpoints'
+
+def chunks(reps, chunk=CHUNK):
+    """Returns the (first, n) of each chunk of reps agents."""
+    return [
+        (first, min(chunk, reps - first)) for first in range(0, reps, chunk)]
+
+def _add(a, b):
+    """Adds two partial sums."""
+    if isinstance(a, tuple):
+        return tuple(_add(x, y) for x, y in zip(a, b))
+    return a + b
+
+def tree_sum(partials):
+    """Adds a list of partial sums pairwise, in order."""
+    partials = list(partials)
+    while len(partials) > 1:
+        partials = [
+            _add(*partials[i:i + 2]) if i + 1 < len(partials) else partials[i]
+            for i in range(0, len(partials), 2)]
+    return partials[0]
+
+def _read_checkpoint(checkpoint_fn, header):
+    """
+    Reads the finished chunks from a checkpoint file.
+
+    Returns a dictionary of partial sums by chunk index. A checkpoint of a
+    different run is ignored, and a truncated last record is discarded.
+    """
+    done = {}
+    try:
+        with open(checkpoint_fn, 'rb') as inf:
+            if pickle.load(inf) != header:
+                print('Ignoring checkpoint {} of a different run'.format(
+                    checkpoint_fn))
+                return {}
+            while True:
+                index, partial = pickle.load(inf)
+                done[index] = partial
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        pass
+    return done
+
+def _write_checkpoint(checkpoint_fn, header, done):
+    """Starts a checkpoint file with the chunks already done."""
+    tmp_fn = '{}.{}.tmp'.format(checkpoint_fn, os.getpid())
+    with open(tmp_fn, 'wb') as outf:
+        pickle.dump(header, outf)
+        for item in done.items():
+            pickle.dump(item, outf)
+    os.replace(tmp_fn, checkpoint_fn)
+
+_TASK = None
+
+def _init_worker(task, args):
+    """Stores the task and its arguments in a worker process."""
+    global _TASK
+    _TASK = (task, args)
+
+def _run_chunk(job):
+    """Runs the task on a chunk in a worker process."""
+    index, first, n = job
+    task, args = _TASK
+    return index, task(first, n, *args)
+
+def run(task, reps, args=(), chunk=CHUNK, processes=None, checkpoint_fn=None,
+        run_id=None, label=None):
+    """
+    Runs a simulation in chunks and adds up the results.
+
+    Keyword parameters:
+    task -- module-level function task(first, n, *args) returning the partial
+        sums of agents first to first + n - 1
+    reps -- number of agents
+    args -- further arguments of task, sent once to each worker
+    chunk -- number of agents per chunk
+    processes -- number of worker processes (default: number of CPUs); 1 runs
+        the chunks in this process
+    checkpoint_fn -- checkpoint file (default: no checkpoint)
+    run_id -- identifier of the run for the checkpoint, e.g. (name, seed)
+    label -- label of the progress messages (default: no progress messages)
+
+    Returns the sum of the partial sums.
+    """
+    jobs = [(i, first, n) for i, (first, n) in enumerate(chunks(reps, chunk))]
+    header = (run_id, reps, chunk)
+    done = {}
+    if checkpoint_fn is not None:
+        done = _read_checkpoint(checkpoint_fn, header)
+        _write_checkpoint(checkpoint_fn, header, done)
+        jobs = [job for job in jobs if job[0] not in done]
+    total = len(done) + len(jobs)
+
+    def finished(index, partial, outf):
+        done[index] = partial
+        if outf is not None:
+            pickle.dump((index, partial), outf)
+            outf.flush()
+        if label is not None:
+            print('\r{}: {} of {} chunks done'.format(
+                label, len(done), total), end='')
+            sys.stdout.flush()
+
+    outf = open(checkpoint_fn, 'ab') if checkpoint_fn is not None else None
+    try:
+        if processes == 1:
+            for index, first, n in jobs:
+                finished(index, task(first, n, *args), outf)
+        elif jobs:
+            with multiprocessing.Pool(
+                    min(processes or os.cpu_count(), len(jobs)),
+                    _init_worker, (task, args)) as pool:
+                for index, partial in pool.imap_unordered(_run_chunk, jobs):
+                    finished(index, partial, outf)
+    finally:
+        if outf is not None:
+            outf.close()
+    if label is not None:
+        print()
+    return tree_sum(done[i] for i in range(total))
+
+def checkpoint_path(name, *key):
+    """Checkpoint file of a script (name) for the run with the given key."""
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    return os.path.join(CHECKPOINT_DIR, '-'.join(
+        [name] + [str(k) for k in key]) + '.ckpt')
+
+def clear_checkpoints(name):
+    """Removes the checkpoint files of a script."""
+    for checkpoint_fn in glob.glob(
+            os.path.join(CHECKPOINT_DIR, name + '-*.ckpt')):
+        os.remove(checkpoint_fn)
+
+def add_processes_argument(parser):
+    """Adds the --processes option to an argument parser."""
+    parser.add_argument(
+        '--processes', help='number of worker processes (default: all CPUs)',
+        type=int, default=None)
@@ -14,71 +14,435 @@
 // along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 #include <vector>
+#include <memory>
 #include <utility>
 #include <Python.h>
 #include <cmath>
 #include <cerrno>
+#include <cstdint>
 #include <iostream>
 #include <limits>
 #include <cassert>
+#include <atomic>
+#include <thread>
 
-void mpl_rs(PyObject* xs, std::vector<double>& rs, int k, double A, double rho, double theta) {
-    if (k == 0) {
-        double mem = 0;
-        for (unsigned int t = 0; t < rs.size(); t++) {
-            int x = PyLong_AsLong(PyList_GET_ITEM(xs, t));
-            rs[t] = theta*mem;
-            mem = rho*A*mem + 2*x - 1;
-        }
-    }
-    else {
-        const int num_mem = (1 << k);
-        int eta = 0;
-        std::vector<double> mem(num_mem, 0);
-        for (int t = 0; t < k; t++) {
-            int x = PyLong_AsLong(PyList_GET_ITEM(xs, t));
+// Binary sequence stored in a Python list of ints
+class ListSeq {
+public:
+    explicit ListSeq(PyObject* list) : list(list) {}
+    Py_ssize_t size() const { return PyList_GET_SIZE(list); }
+    int operator[](Py_ssize_t t) const {
+        return PyLong_AsLong(PyList_GET_ITEM(list, t));
+    }
+private:
+    PyObject* list;
+};
+
+// Integer sequence stored in a contiguous int8, int32 or int64 buffer
+class BufSeq {
+public:
+    BufSeq(const void* data, Py_ssize_t itemsize, Py_ssize_t len) :
+        data(static_cast<const char*>(data)), itemsize(itemsize), len(len) {}
+    Py_ssize_t size() const { return len; }
+    int operator[](Py_ssize_t t) const {
+        return static_cast<int>(wide(t));
+    }
+    // Entry t without narrowing int64 entries to int
+    int64_t wide(Py_ssize_t t) const {
+        if (itemsize == 1) {
+            return reinterpret_cast<const int8_t*>(data)[t];
+        }
+        if (itemsize == 4) {
+            return reinterpret_cast<const int32_t*>(data)[t];
+        }
+        return reinterpret_cast<const int64_t*>(data)[t];
+    }
+    // Subsequence of length n starting at position start
+    BufSeq sub(Py_ssize_t start, Py_ssize_t n) const {
+        return BufSeq(data + start*itemsize, itemsize, n);
+    }
+private:
+    const char* data;
+    Py_ssize_t itemsize;
+    Py_ssize_t len;
+};
+
+// Python buffer that is released when it goes out of scope
+class Buffer {
+public:
+    Buffer() : acquired(false) {}
+    ~Buffer() {
+        if (acquired) {
+            PyBuffer_Release(&view);
+        }
+    }
+    // Gets a contiguous buffer of int8/int32/int64 values, sets a Python error on failure
+    bool get_ints(PyObject* obj, const char* name, bool writable = false) {
+        int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT;
+        if (writable) {
+            flags |= PyBUF_WRITABLE;
+        }
+        if (!get(obj, flags)) {
+            return false;
+        }
+        char f = format();
+        bool is_int = f == 'b' || f == 'B' || f == '?' || f == 'i' || f == 'I' ||
+            f == 'l' || f == 'L' || f == 'q' || f == 'Q';
+        if (!is_int || (view.itemsize != 1 && view.itemsize != 4 && view.itemsize != 8)) {
+            PyErr_Format(PyExc_TypeError, "%s must be an int8, int32 or int64 buffer", name);
+            return false;
+        }
+        return true;
+    }
+    // Gets a contiguous two-dimensional buffer of ints, sets a Python error on failure
+    bool get_int_matrix(PyObject* obj, const char* name) {
+        if (!get_ints(obj, name)) {
+            return false;
+        }
+        if (view.ndim != 2) {
+            PyErr_Format(PyExc_ValueError, "%s must be two-dimensional", name);
+            return false;
+        }
+        return true;
+    }
+    // Gets a contiguous buffer of float64 values, sets a Python error on failure
+    bool get_doubles(PyObject* obj, const char* name, bool writable) {
+        int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT;
+        if (writable) {
+            flags |= PyBUF_WRITABLE;
+        }
+        if (!get(obj, flags)) {
+            return false;
+        }
+        if (view.itemsize != 8 || format() != 'd') {
+            PyErr_Format(PyExc_TypeError, "%s must be a float64 buffer", name);
+            return false;
+        }
+        return true;
+    }
+    Py_ssize_t size() const { return view.len / view.itemsize; }
+    Py_ssize_t rows() const { return view.shape[0]; }
+    Py_ssize_t cols() const { return view.shape[1]; }
+    BufSeq seq() const { return BufSeq(view.buf, view.itemsize, size()); }
+    BufSeq row(Py_ssize_t r) const { return seq().sub(r*cols(), cols()); }
+    double* doubles() const { return static_cast<double*>(view.buf); }
+    // Stores an integer at position i, the buffer must hold ints
+    void set_int(Py_ssize_t i, int v) const {
+        char* data = static_cast<char*>(view.buf);
+        if (view.itemsize == 1) {
+            reinterpret_cast<int8_t*>(data)[i] = v;
+        }
+        else if (view.itemsize == 4) {
+            reinterpret_cast<int32_t*>(data)[i] = v;
+        }
+        else {
+            reinterpret_cast<int64_t*>(data)[i] = v;
+        }
+    }
+    Py_buffer view;
+private:
+    bool get(PyObject* obj, int flags) {
+        if (PyObject_GetBuffer(obj, &view, flags) != 0) {
+            return false;
+        }
+        acquired = true;
+        return true;
+    }
+    char format() const {
+        const char* f = view.format ? view.format : "B";
+        while (*f == '@' || *f == '=' || *f == '<' || *f == '>' || *f == '!') {
+            f++;
+        }
+        return *f;
+    }
+    bool acquired;
+};
+
+// Mixes the bits of z (the splitmix64 finalizer)
+inline uint64_t mix64(uint64_t z) {
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return z ^ (z >> 31);
+}
+
+// xoshiro256** generator, one independent stream per (seed, stream) pair
+class Rng {
+public:
+    Rng(uint64_t seed, uint64_t stream) {
+        uint64_t sm = mix64(seed) ^ mix64(stream + 0x632BE59BD9B4E019ULL);
+        for (int i = 0; i < 4; i++) {
+            sm += 0x9E3779B97F4A7C15ULL;
+            s[i] = mix64(sm);
+        }
+    }
+    uint64_t next() {
+        const uint64_t result = rotl(s[1] * 5, 7) * 9;
+        const uint64_t t = s[1] << 17;
+        s[2] ^= s[0];
+        s[3] ^= s[1];
+        s[1] ^= s[2];
+        s[0] ^= s[3];
+        s[2] ^= t;
+        s[3] = rotl(s[3], 45);
+        return result;
+    }
+    // Uniform random number in [0, 1)
+    double uniform() {
+        return (next() >> 11) * (1.0 / 9007199254740992.0);
+    }
+private:
+    static uint64_t rotl(uint64_t x, int k) {
+        return (x << k) | (x >> (64 - k));
+    }
+    uint64_t s[4];
+};
+
+// MPL memory of order k, advanced one outcome at a time.
+// Instead of decaying all 2^k cells on every trial, each cell stores its
+// value at the trial it was last updated and the decay A^n accumulated
+// since then is applied when the cell is read, so a trial costs O(1).
+class MplMemory {
+public:
+    explicit MplMemory(int k) :
+        k(k), num_mem(1 << k), mem(num_mem, 0), last(num_mem, 0), t(0) {
+        reset(0, 0);
+    }
+    MplMemory(int k, double A, double rho) : MplMemory(k) {
+        reset(A, rho);
+    }
+    // Forgets all outcomes and sets new parameters in O(1) time
+    void reset(double A, double rho) {
+        this->A = A;
+        this->rho = rho;
+        start = t;
+        eta = 0;
+        apow.assign(1, 1);
+    }
+    // Returns the memory of the current context and learns the outcome x
+    double step(int x) {
+        if (t - start < k) {
             eta = (eta << 1) + x;
-            rs[t] = 0;
+            t++;
+            return 0;
         }
-        for (unsigned int t = k; t < rs.size(); t++) {
-            int x = PyLong_AsLong(PyList_GET_ITEM(xs, t));
-            rs[t] = theta*mem[eta];
-            for (int i = 0; i < num_mem; i++) {
-                mem[i] = A*mem[i];
-            }
-            mem[eta] = rho*mem[eta] + 2*x - 1;
-            eta = ((eta << 1) + x) % num_mem;
+        // Cells last updated before the latest reset hold stale values
+        double m = last[eta] > start ? mem[eta]*decay(t - last[eta]) : 0;
+        mem[eta] = rho*A*m + 2*x - 1;
+        last[eta] = t + 1;
+        eta = ((eta << 1) + x) & (num_mem - 1);
+        t++;
+        return m;
+    }
+private:
+    // A^n, from a table that grows with the longest gap between updates
+    double decay(Py_ssize_t n) {
+        while (static_cast<Py_ssize_t>(apow.size()) <= n) {
+            apow.push_back(apow.back()*A);
+        }
+        return apow[n];
+    }
+    int k;
+    int num_mem;
+    double A;
+    double rho;
+    std::vector<double> mem;
+    std::vector<Py_ssize_t> last;
+    std::vector<double> apow;
+    int eta;
+    Py_ssize_t t;
+    Py_ssize_t start;
+};
+
+// Reusable MPL memories, one per k, to avoid reallocating 2^k cells per agent
+class MemoryPool {
+public:
+    MplMemory& get(int k, double A, double rho) {
+        if (static_cast<int>(mems.size()) <= k) {
+            mems.resize(k + 1);
+        }
+        if (!mems[k]) {
+            mems[k].reset(new MplMemory(k));
+        }
+        mems[k]->reset(A, rho);
+        return *mems[k];
+    }
+private:
+    std::vector<std::unique_ptr<MplMemory>> mems;
+};
+
+// Calculates the logits of responding 1 for the first n trials of xs
+template <class Seq>
+void mpl_rs(const Seq& xs, double* rs, Py_ssize_t n, MplMemory& mem, double theta) {
+    for (Py_ssize_t t = 0; t < n; t++) {
+        rs[t] = theta*mem.step(xs[t]);
+    }
+}
+
+template <class Seq>
+void mpl_rs(const Seq& xs, double* rs, Py_ssize_t n, int k, double A, double rho, double theta) {
+    MplMemory mem(k, A, rho);
+    mpl_rs(xs, rs, n, mem, theta);
+}
+
+// Log-probability of response y given the logit f of responding 1
+inline double bernoulli_logit_ll(int y, double f) {
+    if (f > 0) {
+        double e = exp(-f);
+        if (y == 0) {
+            return -(f + log(e + 1));
         }
+        return -log(e + 1);
+    }
+    double e = exp(f);
+    if (y == 0) {
+        return -log(e + 1);
     }
+    return f - log(e + 1);
 }
 
-PyObject* logl(PyObject* xs, PyObject* ys, int ini, int end, int k, double A, double rho, double theta) {
+// Probability of responding 1 given its logit f
+inline double logit_p1(double f) {
+    if (f > 40) {
+        return 1;
+    }
+    double m = exp(f);
+    return m / (1 + m);
+}
+
+template <class Seq>
+double logl(const Seq& xs, const Seq& ys, int ini, int end, int k, double A, double rho, double theta) {
     double ll = 0;
     std::vector<double> rs(end);
-    mpl_rs(xs, rs, k, A, rho, theta);
+    mpl_rs(xs, rs.data(), end, k, A, rho, theta);
     for(int t = ini; t < end; t++) {
-        int y = PyLong_AsLong(PyList_GET_ITEM(ys, t));
-        double f = rs[t];
-        if (f > 0) {
-            double e = exp(-f);
-            if (y == 0) {
-                ll -= f + log(e + 1);
-            }
-            else {
-                ll -= log(e + 1);
+        ll += bernoulli_logit_ll(ys[t], rs[t]);
+    }
+    return ll;
+}
+
+// Log-likelihoods for k = 0..kmax from a single pass over the trials
+template <class Seq>
+void logl_allk(const Seq& xs, const Seq& ys, int ini, int end, int kmax, double A, double rho, double theta, double* lls) {
+    std::vector<MplMemory> mems;
+    for (int k = 0; k <= kmax; k++) {
+        mems.emplace_back(k, A, rho);
+        lls[k] = 0;
+    }
+    for (int t = 0; t < end; t++) {
+        int x = xs[t];
+        for (int k = 0; k <= kmax; k++) {
+            double f = theta*mems[k].step(x);
+            if (t >= ini) {
+                lls[k] += bernoulli_logit_ll(ys[t], f);
             }
         }
-        else {
-            double e = exp(f);
-            if (y == 0) {
-                ll -= log(e + 1);
-            }
-            else {
-                ll += f - log(e + 1);
-            }
+    }
+}
+
+// Log of the sum of exp(vs[i]) for i in [0, n)
+inline double log_sum_exp(const double* vs, int n) {
+    double vmax = -std::numeric_limits<double>::infinity();
+    for (int i = 0; i < n; i++) {
+        if (vs[i] > vmax) {
+            vmax = vs[i];
+        }
+    }
+    if (std::isinf(vmax)) {
+        return vmax;
+    }
+    double sum = 0;
+    for (int i = 0; i < n; i++) {
+        sum += exp(vs[i] - vmax);
+    }
+    return vmax + log(sum);
+}
+
+// MPL memory of order k that also tracks the derivatives of every cell
+// with respect to A and rho (forward mode), with the same lazy decay
+class MplMemoryGrad {
+public:
+    MplMemoryGrad(int k, double A, double rho) :
+        k(k), num_mem(1 << k), A(A), rho(rho), mem(num_mem, 0), dmem_A(num_mem, 0),
+        dmem_rho(num_mem, 0), last(num_mem, 0), apow(1, 1), eta(0), t(0) {}
+    // Returns the memory of the current context and its derivatives
+    // (m, dm/dA, dm/drho) and learns the outcome x
+    void step(int x, double& m, double& m_A, double& m_rho) {
+        if (t < k) {
+            eta = (eta << 1) + x;
+            t++;
+            m = m_A = m_rho = 0;
+            return;
+        }
+        // Value and derivatives of v*A^n, the cell decayed since its last update
+        const Py_ssize_t n = t - last[eta];
+        const double p = decay(n);
+        m = mem[eta]*p;
+        m_A = dmem_A[eta]*p + (n > 0 ? mem[eta]*n*decay(n - 1) : 0);
+        m_rho = dmem_rho[eta]*p;
+        mem[eta] = rho*A*m + 2*x - 1;
+        dmem_A[eta] = rho*(m + A*m_A);
+        dmem_rho[eta] = A*(m + rho*m_rho);
+        last[eta] = t + 1;
+        eta = ((eta << 1) + x) & (num_mem - 1);
+        t++;
+    }
+private:
+    double decay(Py_ssize_t n) {
+        while (static_cast<Py_ssize_t>(apow.size()) <= n) {
+            apow.push_back(apow.back()*A);
+        }
+        return apow[n];
+    }
+    int k;
+    int num_mem;
+    double A;
+    double rho;
+    std::vector<double> mem;
+    std::vector<double> dmem_A;
+    std::vector<double> dmem_rho;
+    std::vector<Py_ssize_t> last;
+    std::vector<double> apow;
+    int eta;
+    Py_ssize_t t;
+};
+
+// Log-likelihood and its gradient with respect to (A, rho, theta)
+template <class Seq>
+double logl_grad(const Seq& xs, const Seq& ys, int ini, int end, int k, double A, double rho, double theta, double* grad) {
+    MplMemoryGrad mem(k, A, rho);
+    double ll = 0;
+    grad[0] = grad[1] = grad[2] = 0;
+    for (int t = 0; t < end; t++) {
+        double m, m_A, m_rho;
+        mem.step(xs[t], m, m_A, m_rho);
+        if (t < ini) {
+            continue;
         }
+        const double f = theta*m;
+        const int y = ys[t];
+        ll += bernoulli_logit_ll(y, f);
+        // d log p(y)/df = y - p1
+        const double p1 = f > 0 ? 1/(1 + exp(-f)) : exp(f)/(1 + exp(f));
+        const double dll = y - p1;
+        grad[0] += dll*theta*m_A;
+        grad[1] += dll*theta*m_rho;
+        grad[2] += dll*m;
     }
-    return PyFloat_FromDouble(ll);
+    return ll;
+}
+
+// Largest k, so that the 2^k memory cells of an agent can be indexed with an
+// int
+const int K_LIMIT = 30;
+
+// Checks that k is in [0, min(K_LIMIT, T)], sets a ValueError otherwise
+bool check_k(int64_t k, Py_ssize_t T, const char* name) {
+    if (k < 0 || k > K_LIMIT || k > T) {
+        PyErr_Format(PyExc_ValueError,
+            "%s must be between 0 and min(%d, number of trials)", name, K_LIMIT);
+        return false;
+    }
+    return true;
 }
 
 static PyObject *
@@ -88,32 +452,155 @@ mpl_logl(PyObject* self, PyObject* args)
     PyObject* ys = 0;
     int ini;
     int end;
-    int k;
+    long long k;
     double A;
     double rho;
     double theta;
-    if (!PyArg_ParseTuple(args, "OOiiiddd", &xs, &ys, &ini, &end, &k, &A, &rho, &theta)) {
+    if (!PyArg_ParseTuple(args, "OOiiLddd", &xs, &ys, &ini, &end, &k, &A, &rho, &theta)) {
         return 0;
     }
-    return logl(xs, ys, ini, end, k, A, rho, theta);
+    if (!check_k(k, end, "k")) {
+        return 0;
+    }
+    return PyFloat_FromDouble(logl(ListSeq(xs), ListSeq(ys), ini, end, k, A, rho, theta));
+}
+
+static PyObject *
+mpl_logl_buf(PyObject* self, PyObject* args)
+{
+    PyObject* xs = 0;
+    PyObject* ys = 0;
+    int ini;
+    int end;
+    long long k;
+    double A;
+    double rho;
+    double theta;
+    if (!PyArg_ParseTuple(args, "OOiiLddd", &xs, &ys, &ini, &end, &k, &A, &rho, &theta)) {
+        return 0;
+    }
+    Buffer xbuf, ybuf;
+    if (!xbuf.get_ints(xs, "xs") || !ybuf.get_ints(ys, "ys")) {
+        return 0;
+    }
+    if (ini < 0 || end < ini || end > xbuf.size() || end > ybuf.size()) {
+        PyErr_SetString(PyExc_ValueError, "invalid trial range");
+        return 0;
+    }
+    if (!check_k(k, xbuf.size(), "k")) {
+        return 0;
+    }
+    return PyFloat_FromDouble(logl(xbuf.seq(), ybuf.seq(), ini, end, k, A, rho, theta));
+}
+
+static PyObject *
+mpl_logl_allk(PyObject* self, PyObject* args)
+{
+    PyObject* xs = 0;
+    PyObject* ys = 0;
+    int ini;
+    int end;
+    long long kmax;
+    double A;
+    double rho;
+    double theta;
+    if (!PyArg_ParseTuple(args, "OOiiLddd", &xs, &ys, &ini, &end, &kmax, &A, &rho, &theta)) {
+        return 0;
+    }
+    Buffer xbuf, ybuf;
+    if (!xbuf.get_ints(xs, "xs") || !ybuf.get_ints(ys, "ys")) {
+        return 0;
+    }
+    if (ini < 0 || end < ini || end > xbuf.size() || end > ybuf.size()) {
+        PyErr_SetString(PyExc_ValueError, "invalid trial range");
+        return 0;
+    }
+    if (!check_k(kmax, xbuf.size(), "kmax")) {
+        return 0;
+    }
+    std::vector<double> lls(kmax + 1);
+    logl_allk(xbuf.seq(), ybuf.seq(), ini, end, kmax, A, rho, theta, lls.data());
+    PyObject* result = PyTuple_New(kmax + 1);
+    for (int k = 0; k <= kmax; k++) {
+        PyTuple_SET_ITEM(result, k, PyFloat_FromDouble(lls[k]));
+    }
+    return result;
+}
+
+static PyObject *
+mpl_logl_mixk(PyObject* self, PyObject* args)
+{
+    PyObject* xs = 0;
+    PyObject* ys = 0;
+    int ini;
+    int end;
+    PyObject* probk = 0;
+    double A;
+    double rho;
+    double theta;
+    if (!PyArg_ParseTuple(args, "OOiiOddd", &xs, &ys, &ini, &end, &probk, &A, &rho, &theta)) {
+        return 0;
+    }
+    Buffer xbuf, ybuf, pbuf;
+    if (!xbuf.get_ints(xs, "xs") || !ybuf.get_ints(ys, "ys") ||
+            !pbuf.get_doubles(probk, "probk", false)) {
+        return 0;
+    }
+    if (ini < 0 || end < ini || end > xbuf.size() || end > ybuf.size() || pbuf.size() == 0) {
+        PyErr_SetString(PyExc_ValueError, "invalid trial range or empty probk");
+        return 0;
+    }
+    if (!check_k(pbuf.size() - 1, xbuf.size(), "len(probk) - 1")) {
+        return 0;
+    }
+    const int kmax = pbuf.size() - 1;
+    std::vector<double> lls(kmax + 1);
+    logl_allk(xbuf.seq(), ybuf.seq(), ini, end, kmax, A, rho, theta, lls.data());
+    for (int k = 0; k <= kmax; k++) {
+        lls[k] += log(pbuf.doubles()[k]);
+    }
+    return PyFloat_FromDouble(log_sum_exp(lls.data(), kmax + 1));
+}
+
+static PyObject *
+mpl_logl_grad(PyObject* self, PyObject* args)
+{
+    PyObject* xs = 0;
+    PyObject* ys = 0;
+    int ini;
+    int end;
+    long long k;
+    double A;
+    double rho;
+    double theta;
+    if (!PyArg_ParseTuple(args, "OOiiLddd", &xs, &ys, &ini, &end, &k, &A, &rho, &theta)) {
+        return 0;
+    }
+    Buffer xbuf, ybuf;
+    if (!xbuf.get_ints(xs, "xs") || !ybuf.get_ints(ys, "ys")) {
+        return 0;
+    }
+    if (ini < 0 || end < ini || end > xbuf.size() || end > ybuf.size()) {
+        PyErr_SetString(PyExc_ValueError, "invalid trial range");
+        return 0;
+    }
+    if (!check_k(k, xbuf.size(), "k")) {
+        return 0;
+    }
+    double grad[3];
+    double ll = logl_grad(xbuf.seq(), ybuf.seq(), ini, end, k, A, rho, theta, grad);
+    // Chain rule for A = inv_logit(a), rho = inv_logit(r), theta = exp(l)
+    return Py_BuildValue("d(ddd)(ddd)", ll, grad[0], grad[1], grad[2],
+        grad[0]*A*(1 - A), grad[1]*rho*(1 - rho), grad[2]*theta);
 }
 
 PyObject* model(PyObject* xs, int k, double A, double rho, double theta) {
     unsigned int M = PyList_GET_SIZE(xs);
     std::vector<double> rs(M);
-    mpl_rs(xs, rs, k, A, rho, theta);
+    mpl_rs(ListSeq(xs), rs.data(), M, k, A, rho, theta);
     PyObject* p1s = PyTuple_New(PyList_GET_SIZE(xs));
     for(unsigned int t = 0; t < M; t++) {
-        double f = rs[t];
-        double p1;
-        if (f > 40) {
-            p1 = 1;
-        }
-        else {
-            double m = exp(f);
-            p1 = m / (1 + m);
-        }
-        PyTuple_SET_ITEM(p1s, t, PyFloat_FromDouble(p1));
+        PyTuple_SET_ITEM(p1s, t, PyFloat_FromDouble(logit_p1(rs[t])));
     }
     return p1s;
 }
@@ -122,21 +609,363 @@ static PyObject *
 mpl_model(PyObject* self, PyObject* args)
 {
     PyObject* xs = 0;
-    int k;
+    long long k;
     double A;
     double rho;
     double theta;
-    if (!PyArg_ParseTuple(args, "Oiddd", &xs, &k, &A, &rho, &theta)) {
+    if (!PyArg_ParseTuple(args, "OLddd", &xs, &k, &A, &rho, &theta)) {
+        return 0;
+    }
+    if (!check_k(k, PyList_GET_SIZE(xs), "k")) {
         return 0;
     }
     return model(xs, k, A, rho, theta);
 }
 
+static PyObject *
+mpl_model_buf(PyObject* self, PyObject* args)
+{
+    PyObject* xs = 0;
+    long long k;
+    double A;
+    double rho;
+    double theta;
+    PyObject* p1s = 0;
+    if (!PyArg_ParseTuple(args, "OLdddO", &xs, &k, &A, &rho, &theta, &p1s)) {
+        return 0;
+    }
+    Buffer xbuf, pbuf;
+    if (!xbuf.get_ints(xs, "xs") || !pbuf.get_doubles(p1s, "p1s", true)) {
+        return 0;
+    }
+    if (pbuf.size() != xbuf.size()) {
+        PyErr_SetString(PyExc_ValueError, "xs and p1s must have the same length");
+        return 0;
+    }
+    if (!check_k(k, xbuf.size(), "k")) {
+        return 0;
+    }
+    double* out = pbuf.doubles();
+    mpl_rs(xbuf.seq(), out, xbuf.size(), k, A, rho, theta);
+    for (Py_ssize_t t = 0; t < xbuf.size(); t++) {
+        out[t] = logit_p1(out[t]);
+    }
+    Py_RETURN_NONE;
+}
+
+// check_k for every entry of a vector of ks
+bool check_ks(const BufSeq& ks, Py_ssize_t T) {
+    for (Py_ssize_t r = 0; r < ks.size(); r++) {
+        if (!check_k(ks.wide(r), T, "ks")) {
+            return false;
+        }
+    }
+    return true;
+}
+
+static PyObject *
+mpl_simulate_batch(PyObject* self, PyObject* args)
+{
+    PyObject* xs = 0;
+    PyObject* ks = 0;
+    PyObject* As = 0;
+    PyObject* rhos = 0;
+    PyObject* thetas = 0;
+    unsigned long long seed;
+    PyObject* p1s = Py_None;
+    PyObject* ys = Py_None;
+    Py_ssize_t first = 0;
+    if (!PyArg_ParseTuple(args, "OOOOOK|OOn", &xs, &ks, &As, &rhos, &thetas, &seed, &p1s, &ys, &first)) {
+        return 0;
+    }
+    Buffer xbuf, kbuf, Abuf, rhobuf, thetabuf, pbuf, ybuf;
+    if (!xbuf.get_int_matrix(xs, "xs") || !kbuf.get_ints(ks, "ks") ||
+            !Abuf.get_doubles(As, "As", false) || !rhobuf.get_doubles(rhos, "rhos", false) ||
+            !thetabuf.get_doubles(thetas, "thetas", false)) {
+        return 0;
+    }
+    const Py_ssize_t R = xbuf.rows();
+    const Py_ssize_t T = xbuf.cols();
+    if (kbuf.size() != R || Abuf.size() != R || rhobuf.size() != R || thetabuf.size() != R) {
+        PyErr_SetString(PyExc_ValueError, "parameter vectors must have one entry per row of xs");
+        return 0;
+    }
+    if (p1s == Py_None && ys == Py_None) {
+        PyErr_SetString(PyExc_ValueError, "at least one of p1s and ys must be given");
+        return 0;
+    }
+    if (p1s != Py_None && !pbuf.get_doubles(p1s, "p1s", true)) {
+        return 0;
+    }
+    if (ys != Py_None && !ybuf.get_ints(ys, "ys", true)) {
+        return 0;
+    }
+    if ((p1s != Py_None && pbuf.size() != R*T) || (ys != Py_None && ybuf.size() != R*T)) {
+        PyErr_SetString(PyExc_ValueError, "outputs must have the same shape as xs");
+        return 0;
+    }
+    const BufSeq kseq = kbuf.seq();
+    if (!check_ks(kseq, T)) {
+        return 0;
+    }
+    std::vector<double> rs(T);
+    MemoryPool pool;
+    for (Py_ssize_t r = 0; r < R; r++) {
+        MplMemory& mem = pool.get(kseq[r], Abuf.doubles()[r], rhobuf.doubles()[r]);
+        mpl_rs(xbuf.row(r), rs.data(), T, mem, thetabuf.doubles()[r]);
+        Rng rng(seed, first + r);
+        for (Py_ssize_t t = 0; t < T; t++) {
+            double p1 = logit_p1(rs[t]);
+            if (p1s != Py_None) {
+                pbuf.doubles()[r*T + t] = p1;
+            }
+            if (ys != Py_None) {
+                ybuf.set_int(r*T + t, rng.uniform() < p1);
+            }
+        }
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+mpl_mean_curve(PyObject* self, PyObject* args)
+{
+    Py_ssize_t n_agents;
+    Py_ssize_t T;
+    double p_majority;
+    PyObject* ks = 0;
+    PyObject* As = 0;
+    PyObject* rhos = 0;
+    PyObject* thetas = 0;
+    unsigned long long seed;
+    Py_ssize_t first = 0;
+    if (!PyArg_ParseTuple(args, "nndOOOOK|n", &n_agents, &T, &p_majority, &ks, &As, &rhos, &thetas, &seed, &first)) {
+        return 0;
+    }
+    Buffer kbuf, Abuf, rhobuf, thetabuf;
+    if (!kbuf.get_ints(ks, "ks") || !Abuf.get_doubles(As, "As", false) ||
+            !rhobuf.get_doubles(rhos, "rhos", false) || !thetabuf.get_doubles(thetas, "thetas", false)) {
+        return 0;
+    }
+    const Py_ssize_t P = kbuf.size();
+    if (P == 0 || Abuf.size() != P || rhobuf.size() != P || thetabuf.size() != P) {
+        PyErr_SetString(PyExc_ValueError, "parameter vectors must be non-empty and of equal length");
+        return 0;
+    }
+    if (n_agents < 0 || T < 0) {
+        PyErr_SetString(PyExc_ValueError, "n_agents and ntrials must be non-negative");
+        return 0;
+    }
+    const BufSeq kseq = kbuf.seq();
+    if (!check_ks(kseq, T)) {
+        return 0;
+    }
+    std::vector<int> xs(T);
+    std::vector<double> rs(T);
+    std::vector<double> sum(T, 0);
+    MemoryPool pool;
+    for (Py_ssize_t i = 0; i < n_agents; i++) {
+        Rng rng(seed, first + i);
+        for (Py_ssize_t t = 0; t < T; t++) {
+            xs[t] = rng.uniform() < p_majority;
+        }
+        const Py_ssize_t j = i % P;
+        MplMemory& mem = pool.get(kseq[j], Abuf.doubles()[j], rhobuf.doubles()[j]);
+        mpl_rs(xs, rs.data(), T, mem, thetabuf.doubles()[j]);
+        for (Py_ssize_t t = 0; t < T; t++) {
+            sum[t] += logit_p1(rs[t]);
+        }
+    }
+    PyObject* sums = PyTuple_New(T);
+    for (Py_ssize_t t = 0; t < T; t++) {
+        PyTuple_SET_ITEM(sums, t, PyFloat_FromDouble(sum[t]));
+    }
+    return sums;
+}
+
+// Runs f(i) for i in [0, n) on n_threads threads (0 = all hardware threads)
+template <class F>
+void parallel_for(Py_ssize_t n, int n_threads, const F& f) {
+    if (n_threads <= 0) {
+        n_threads = std::thread::hardware_concurrency();
+    }
+    if (n_threads > n) {
+        n_threads = n;
+    }
+    if (n_threads <= 1) {
+        for (Py_ssize_t i = 0; i < n; i++) {
+            f(i);
+        }
+        return;
+    }
+    std::atomic<Py_ssize_t> next(0);
+    auto work = [&]() {
+        for (Py_ssize_t i = next++; i < n; i = next++) {
+            f(i);
+        }
+    };
+    std::vector<std::thread> threads;
+    for (int i = 1; i < n_threads; i++) {
+        threads.emplace_back(work);
+    }
+    work();
+    for (auto& thread : threads) {
+        thread.join();
+    }
+}
+
+static PyObject *
+mpl_logl_batch(PyObject* self, PyObject* args)
+{
+    PyObject* xs = 0;
+    PyObject* ys = 0;
+    PyObject* ks = 0;
+    PyObject* As = 0;
+    PyObject* rhos = 0;
+    PyObject* thetas = 0;
+    PyObject* lls = 0;
+    int n_threads = 0;
+    PyObject* rows = Py_None;
+    if (!PyArg_ParseTuple(args, "OOOOOOO|iO", &xs, &ys, &ks, &As, &rhos, &thetas, &lls, &n_threads, &rows)) {
+        return 0;
+    }
+    Buffer xbuf, ybuf, kbuf, Abuf, rhobuf, thetabuf, llbuf, rowbuf;
+    if (!xbuf.get_int_matrix(xs, "xs") || !ybuf.get_int_matrix(ys, "ys") ||
+            !kbuf.get_ints(ks, "ks") || !Abuf.get_doubles(As, "As", false) ||
+            !rhobuf.get_doubles(rhos, "rhos", false) || !thetabuf.get_doubles(thetas, "thetas", false) ||
+            !llbuf.get_doubles(lls, "lls", true)) {
+        return 0;
+    }
+    if (rows != Py_None && !rowbuf.get_ints(rows, "rows")) {
+        return 0;
+    }
+    const Py_ssize_t D = xbuf.rows();
+    const Py_ssize_t T = xbuf.cols();
+    const Py_ssize_t R = kbuf.size();
+    if (ybuf.rows() != D || ybuf.cols() != T) {
+        PyErr_SetString(PyExc_ValueError, "xs and ys must have the same shape");
+        return 0;
+    }
+    if (Abuf.size() != R || rhobuf.size() != R || thetabuf.size() != R || llbuf.size() != R ||
+            (rows != Py_None && rowbuf.size() != R)) {
+        PyErr_SetString(PyExc_ValueError, "parameter vectors and lls must have equal length");
+        return 0;
+    }
+    if (rows == Py_None && R != D) {
+        PyErr_SetString(PyExc_ValueError, "without rows, xs must have one row per parameter set");
+        return 0;
+    }
+    const BufSeq kseq = kbuf.seq();
+    if (!check_ks(kseq, T)) {
+        return 0;
+    }
+    const BufSeq rowseq = rows != Py_None ? rowbuf.seq() : BufSeq(0, 1, 0);
+    if (rows != Py_None) {
+        for (Py_ssize_t r = 0; r < R; r++) {
+            if (rowseq[r] < 0 || rowseq[r] >= D) {
+                PyErr_SetString(PyExc_IndexError, "rows out of range");
+                return 0;
+            }
+        }
+    }
+    Py_BEGIN_ALLOW_THREADS
+    parallel_for(R, n_threads, [&](Py_ssize_t r) {
+        const Py_ssize_t d = rows != Py_None ? rowseq[r] : r;
+        llbuf.doubles()[r] = logl(xbuf.row(d), ybuf.row(d), 0, T, kseq[r],
+            Abuf.doubles()[r], rhobuf.doubles()[r], thetabuf.doubles()[r]);
+    });
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+mpl_logl_allk_batch(PyObject* self, PyObject* args)
+{
+    PyObject* xs = 0;
+    PyObject* ys = 0;
+    long long kmax;
+    PyObject* As = 0;
+    PyObject* rhos = 0;
+    PyObject* thetas = 0;
+    PyObject* lls = 0;
+    int n_threads = 0;
+    PyObject* rows = Py_None;
+    if (!PyArg_ParseTuple(args, "OOLOOOO|iO", &xs, &ys, &kmax, &As, &rhos, &thetas, &lls, &n_threads, &rows)) {
+        return 0;
+    }
+    Buffer xbuf, ybuf, Abuf, rhobuf, thetabuf, llbuf, rowbuf;
+    if (!xbuf.get_int_matrix(xs, "xs") || !ybuf.get_int_matrix(ys, "ys") ||
+            !Abuf.get_doubles(As, "As", false) || !rhobuf.get_doubles(rhos, "rhos", false) ||
+            !thetabuf.get_doubles(thetas, "thetas", false) || !llbuf.get_doubles(lls, "lls", true)) {
+        return 0;
+    }
+    if (rows != Py_None && !rowbuf.get_ints(rows, "rows")) {
+        return 0;
+    }
+    const Py_ssize_t D = xbuf.rows();
+    const Py_ssize_t T = xbuf.cols();
+    const Py_ssize_t R = Abuf.size();
+    if (ybuf.rows() != D || ybuf.cols() != T) {
+        PyErr_SetString(PyExc_ValueError, "xs and ys must have the same shape");
+        return 0;
+    }
+    if (!check_k(kmax, T, "kmax")) {
+        return 0;
+    }
+    if (rhobuf.size() != R || thetabuf.size() != R || llbuf.size() != R*(kmax + 1) ||
+            (rows != Py_None && rowbuf.size() != R)) {
+        PyErr_SetString(PyExc_ValueError, "parameter vectors must have equal length and lls kmax + 1 entries per set");
+        return 0;
+    }
+    if (rows == Py_None && R != D) {
+        PyErr_SetString(PyExc_ValueError, "without rows, xs must have one row per parameter set");
+        return 0;
+    }
+    const BufSeq rowseq = rows != Py_None ? rowbuf.seq() : BufSeq(0, 1, 0);
+    if (rows != Py_None) {
+        for (Py_ssize_t r = 0; r < R; r++) {
+            if (rowseq[r] < 0 || rowseq[r] >= D) {
+                PyErr_SetString(PyExc_IndexError, "rows out of range");
+                return 0;
+            }
+        }
+    }
+    Py_BEGIN_ALLOW_THREADS
+    parallel_for(R, n_threads, [&](Py_ssize_t r) {
+        const Py_ssize_t d = rows != Py_None ? rowseq[r] : r;
+        logl_allk(xbuf.row(d), ybuf.row(d), 0, T, kmax, Abuf.doubles()[r],
+            rhobuf.doubles()[r], thetabuf.doubles()[r], llbuf.doubles() + r*(kmax + 1));
+    });
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
+}
+
 static PyMethodDef MarkovModelMethods[] = {
     {"mpl_logl",  mpl_logl, METH_VARARGS,
     "Returns the log-likehood of the sequence ys."},
     {"mpl",  mpl_model, METH_VARARGS,
     "Simulates the MPL model, returns list of p1s."},
+    {"mpl_logl_buf",  mpl_logl_buf, METH_VARARGS,
+    "Returns the log-likehood of the sequence ys (int8/int32 buffers)."},
+    {"mpl_buf",  mpl_model_buf, METH_VARARGS,
+    "Simulates the MPL model, writes p1s into a float64 buffer."},
+    {"simulate_batch",  mpl_simulate_batch, METH_VARARGS,
+    "Simulates one MPL agent per row of xs, writes p1s and/or random ys.\n"
+    "Row r uses the random stream of agent first + r."},
+    {"mean_curve",  mpl_mean_curve, METH_VARARGS,
+    "Simulates agents on random outcomes, returns the sum of p1s per trial.\n"
+    "Agent i uses the random stream of agent first + i."},
+    {"mpl_logl_batch",  mpl_logl_batch, METH_VARARGS,
+    "Computes log-likelihoods for many parameter sets on multiple threads."},
+    {"mpl_logl_allk",  mpl_logl_allk, METH_VARARGS,
+    "Returns the log-likelihoods of the sequence ys for k = 0..kmax."},
+    {"mpl_logl_mixk",  mpl_logl_mixk, METH_VARARGS,
+    "Returns the log-likelihood of the sequence ys marginalised over k."},
+    {"mpl_logl_allk_batch",  mpl_logl_allk_batch, METH_VARARGS,
+    "Computes log-likelihoods for k = 0..kmax for many parameter sets."},
+    {"mpl_logl_grad",  mpl_logl_grad, METH_VARARGS,
+    "Returns the log-likelihood, its gradient w.r.t. (A, rho, theta) and "
+    "w.r.t. (logit A, logit rho, log theta)."},
     {0, 0, 0, 0}        /* Sentinel */
 };
 
@@ -0,0 +1,319 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+MPL model functions with interchangeable backends.
+
+There are three backends:
+c -- the C++ module in mpl.cpp (compile it with setup.py)
+numba -- Numba JIT-compiled kernels in mpl_numba.py
+numpy -- the vectorized NumPy implementation in mpl_python.py
+The backend is selected with the MPL_BACKEND environment variable. If it is
+not set, the first available backend in the order above is used.
+
+Outcome and response sequences may be lists or NumPy arrays. The functions
+return NumPy arrays.
+
+simulate_batch and mean_curve draw the random numbers of agent i from a stream
+determined by the seed and first + i, so a run split into chunks of agents
+(with first set to the index of the first agent of each chunk) gives the same
+results as a single run. The streams differ between backends.
+"""
+
+import os
+import numpy as np
+import mpl_python
+from seeding import generator
+
+BACKENDS = ('c', 'numba', 'numpy')
+CHUNK = 10000 # Number of agents simulated at a time by mean_curve
+AGENT_BLOCK = 1000 # Number of agents per random stream in the NumPy backends
+K_LIMIT = 30 # Largest k accepted by the C++ module
+
+def _seqs(*seqs):
+    """Converts sequences of 0s and 1s to contiguous int8 arrays."""
+    return [np.ascontiguousarray(seq, dtype=np.int8) for seq in seqs]
+
+def _params(n, *params):
+    """Converts parameters (vectors or scalars) to float64 vectors of size n."""
+    return [
+        np.ascontiguousarray(np.broadcast_to(param, (n,)), dtype=float)
+        for param in params]
+
+def _ints(n, ints):
+    """Converts ints (vector or scalar) to an int64 vector of size n."""
+    return np.ascontiguousarray(np.broadcast_to(ints, (n,)), dtype=np.int64)
+
+def _p1s(rs):
+    """Probabilities of responding 1 from their logits."""
+    e = np.exp(np.minimum(rs, 40))
+    return np.where(rs > 40, 1, e/(1 + e))
+
+def _logls(rs, ys):
+    """Log-probabilities of the responses ys given the logits rs."""
+    return -np.logaddexp(0, np.where(ys == 1, -rs, rs))
+
+def _uniforms(seed, first, n, ntrials):
+    """
+    Uniform random numbers for agents first to first + n - 1.
+
+    Returns an n x ntrials array. The agents are divided into blocks of
+    AGENT_BLOCK, each with its own stream, so an agent's numbers do not depend
+    on first and n.
+    """
+    us = np.empty((n, ntrials))
+    for block in range(first//AGENT_BLOCK, -(-(first + n)//AGENT_BLOCK)):
+        ini = block*AGENT_BLOCK
+        u = generator(seed, block).random((AGENT_BLOCK, ntrials))
+        lo, hi = max(first, ini), min(first + n, ini + AGENT_BLOCK)
+        us[lo - first:hi - first] = u[lo - ini:hi - ini]
+    return us
+
+def _grads(A, rho, theta, ll, g_A, g_rho, g_theta):
+    """Gradient w.r.t. the constrained and unconstrained parameters."""
+    return ll, (g_A, g_rho, g_theta),\
+        (g_A*A*(1 - A), g_rho*rho*(1 - rho), g_theta*theta)
+
+FUNCTIONS = (
+    'mpl', 'mpl_logl', 'mpl_logl_allk', 'mpl_logl_mixk', 'mpl_logl_grad',
+    'mpl_batch', 'simulate_batch', 'mean_curve', 'mpl_logl_batch',
+    'mpl_logl_allk_batch')
+
+def _export(namespace):
+    """Dictionary of the backend functions in a namespace."""
+    return {name: namespace[name] for name in FUNCTIONS}
+
+def _c_backend():
+    """Backend functions implemented with the C++ module."""
+    import mpl as ext
+
+    def mpl(xs, k, A, rho, theta):
+        xs, = _seqs(xs)
+        p1s = np.empty(len(xs))
+        ext.mpl_buf(xs, k, A, rho, theta, p1s)
+        return p1s
+
+    def mpl_logl(xs, ys, ini, end, k, A, rho, theta):
+        return ext.mpl_logl_buf(*_seqs(xs, ys), ini, end, k, A, rho, theta)
+
+    def mpl_logl_allk(xs, ys, ini, end, kmax, A, rho, theta):
+        return np.array(ext.mpl_logl_allk(
+            *_seqs(xs, ys), ini, end, kmax, A, rho, theta))
+
+    def mpl_logl_mixk(xs, ys, ini, end, probk, A, rho, theta):
+        probk, = _params(len(probk), probk)
+        return ext.mpl_logl_mixk(*_seqs(xs, ys), ini, end, probk, A, rho, theta)
+
+    def mpl_logl_grad(xs, ys, ini, end, k, A, rho, theta):
+        return ext.mpl_logl_grad(*_seqs(xs, ys), ini, end, k, A, rho, theta)
+
+    def mpl_batch(xs, ks, As, rhos, thetas):
+        xs, = _seqs(xs)
+        p1s = np.empty(xs.shape)
+        ext.simulate_batch(
+            xs, _ints(len(xs), ks), *_params(len(xs), As, rhos, thetas), 0, p1s)
+        return p1s
+
+    def simulate_batch(xs, ks, As, rhos, thetas, seed, first=0):
+        xs, = _seqs(xs)
+        p1s = np.empty(xs.shape)
+        ys = np.empty(xs.shape, np.int8)
+        ext.simulate_batch(
+            xs, _ints(len(xs), ks), *_params(len(xs), As, rhos, thetas), seed,
+            p1s, ys, first)
+        return p1s, ys
+
+    def mean_curve(
+            n_agents, ntrials, p_majority, ks, As, rhos, thetas, seed,
+            first=0):
+        ks = np.atleast_1d(ks)
+        return np.array(ext.mean_curve(
+            n_agents, ntrials, p_majority, _ints(len(ks), ks),
+            *_params(len(ks), As, rhos, thetas), seed, first))
+
+    def mpl_logl_batch(xs, ys, ks, As, rhos, thetas, n_threads=0, rows=None):
+        xs, ys = _seqs(xs, ys)
+        ks = np.atleast_1d(ks)
+        lls = np.empty(len(ks))
+        ext.mpl_logl_batch(
+            xs, ys, _ints(len(ks), ks), *_params(len(ks), As, rhos, thetas),
+            lls, n_threads, None if rows is None else _ints(len(ks), rows))
+        return lls
+
+    def mpl_logl_allk_batch(
+            xs, ys, kmax, As, rhos, thetas, n_threads=0, rows=None):
+        xs, ys = _seqs(xs, ys)
+        As = np.atleast_1d(As)
+        if not 0 <= kmax <= K_LIMIT:
+            # Checked before allocating lls, which has kmax + 1 columns
+            raise ValueError(
+                'kmax must be between 0 and min({}, number of trials)'.format(
+                    K_LIMIT))
+        lls = np.empty((len(As), kmax + 1))
+        ext.mpl_logl_allk_batch(
+            xs, ys, kmax, *_params(len(As), As, rhos, thetas), lls, n_threads,
+            None if rows is None else _ints(len(As), rows))
+        return lls
+
+    return _export(locals())
+
+def _kernel_backend(logits, logl_grad):
+    """
+    Backend functions built on two kernels.
+
+    Keyword parameters:
+    logits -- function (xs, ks, As, rhos, thetas, n_threads) returning the
+        logits of responding 1 for a batch of agents, one per row of xs
+    logl_grad -- function (xs, ys, ini, end, k, A, rho, theta) returning the
+        log-likelihood and its derivatives w.r.t. A, rho, and theta
+    """
+    def batch_logits(xs, ks, As, rhos, thetas, n_threads=0):
+        xs, = _seqs(xs)
+        return logits(
+            xs, _ints(len(xs), ks), *_params(len(xs), As, rhos, thetas),
+            n_threads)
+
+    def mpl(xs, k, A, rho, theta):
+        return _p1s(batch_logits([xs], k, A, rho, theta)[0])
+
+    def mpl_logl_allk(xs, ys, ini, end, kmax, A, rho, theta):
+        xs, ys = _seqs(xs, ys)
+        rs = batch_logits(
+            np.tile(xs[:end], (kmax + 1, 1)), np.arange(kmax + 1), A, rho,
+            theta)
+        return _logls(rs[:, ini:], ys[ini:end]).sum(axis=1)
+
+    def mpl_logl(xs, ys, ini, end, k, A, rho, theta):
+        xs, ys = _seqs(xs, ys)
+        rs = batch_logits([xs[:end]], k, A, rho, theta)[0]
+        return _logls(rs[ini:], ys[ini:end]).sum()
+
+    def mpl_logl_mixk(xs, ys, ini, end, probk, A, rho, theta):
+        lls = mpl_logl_allk(xs, ys, ini, end, len(probk) - 1, A, rho, theta)
+        return np.logaddexp.reduce(np.log(probk) + lls)
+
+    def mpl_logl_grad(xs, ys, ini, end, k, A, rho, theta):
+        return _grads(A, rho, theta, *logl_grad(
+            *_seqs(xs, ys), ini, end, k, A, rho, theta))
+
+    def mpl_batch(xs, ks, As, rhos, thetas):
+        return _p1s(batch_logits(xs, ks, As, rhos, thetas))
+
+    def simulate_batch(xs, ks, As, rhos, thetas, seed, first=0):
+        p1s = mpl_batch(xs, ks, As, rhos, thetas)
+        us = _uniforms(seed, first, *p1s.shape)
+        return p1s, (us < p1s).astype(np.int8)
+
+    def mean_curve(
+            n_agents, ntrials, p_majority, ks, As, rhos, thetas, seed,
+            first=0):
+        ks = np.atleast_1d(ks)
+        ks, As, rhos, thetas = _ints(len(ks), ks), *_params(
+            len(ks), As, rhos, thetas)
+        sum_resp = np.zeros(ntrials)
+        for start in range(0, n_agents, CHUNK):
+            j = np.arange(start, min(start + CHUNK, n_agents)) % len(ks)
+            xs = _uniforms(seed, first + start, len(j), ntrials) < p_majority
+            sum_resp += mpl_batch(xs, ks[j], As[j], rhos[j], thetas[j]).sum(
+                axis=0)
+        return sum_resp
+
+    def mpl_logl_batch(xs, ys, ks, As, rhos, thetas, n_threads=0, rows=None):
+        xs, ys = _seqs(xs, ys)
+        if rows is not None:
+            xs, ys = xs[rows], ys[rows]
+        rs = batch_logits(xs, ks, As, rhos, thetas, n_threads)
+        return _logls(rs, ys).sum(axis=1)
+
+    def mpl_logl_allk_batch(
+            xs, ys, kmax, As, rhos, thetas, n_threads=0, rows=None):
+        xs, ys = _seqs(xs, ys)
+        if rows is not None:
+            xs, ys = xs[rows], ys[rows]
+        n = len(xs)
+        As, rhos, thetas = (
+            np.repeat(p, kmax + 1) for p in _params(n, As, rhos, thetas))
+        rs = batch_logits(
+            np.repeat(xs, kmax + 1, axis=0), np.tile(np.arange(kmax + 1), n),
+            As, rhos, thetas, n_threads)
+        lls = _logls(rs, np.repeat(ys, kmax + 1, axis=0)).sum(axis=1)
+        return lls.reshape(n, kmax + 1)
+
+    return _export(locals())
+
+def _numba_backend():
+    """Backend functions implemented with Numba kernels."""
+    import mpl_numba
+    return _kernel_backend(mpl_numba.logits, mpl_numba.mpl_logl_grad)
+
+def _numpy_backend():
+    """Backend functions implemented with NumPy."""
+    return _kernel_backend(
+        lambda xs, ks, As, rhos, thetas, n_threads:
+        mpl_python.mpl_batch_logits(xs, ks, As, rhos, thetas),
+        mpl_python.mpl_logl_grad)
+
+_LOADERS = {
+    'c': _c_backend,
+    'numba': _numba_backend,
+    'numpy': _numpy_backend,
+}
+
+def load_backend(name):
+    """
+    Loads a backend by name.
+
+    Returns a dictionary of the backend functions. Raises ImportError if the
+    backend is not available.
+    """
+    if name not in _LOADERS:
+        raise ValueError('Unknown MPL backend {} (choose from {})'.format(
+            name, ', '.join(BACKENDS)))
+    return _LOADERS[name]()
+
+def available_backends():
+    """Returns the names of the backends that can be loaded."""
+    names = []
+    for name in BACKENDS:
+        try:
+            load_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def _select_backend():
+    """Loads the backend set in MPL_BACKEND or the first available one."""
+    name = os.environ.get('MPL_BACKEND')
+    if name:
+        return name, load_backend(name)
+    for name in BACKENDS:
+        try:
+            return name, load_backend(name)
+        except ImportError:
+            continue
+    raise ImportError('No MPL backend available')
+
+BACKEND, _functions = _select_backend()
+mpl = _functions['mpl']
+mpl_logl = _functions['mpl_logl']
+mpl_logl_allk = _functions['mpl_logl_allk']
+mpl_logl_mixk = _functions['mpl_logl_mixk']
+mpl_logl_grad = _functions['mpl_logl_grad']
+mpl_batch = _functions['mpl_batch']
+simulate_batch = _functions['simulate_batch']
+mean_curve = _functions['mean_curve']
+mpl_logl_batch = _functions['mpl_logl_batch']
+mpl_logl_allk_batch = _functions['mpl_logl_allk_batch']
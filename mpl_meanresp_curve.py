@@ -16,42 +16,90 @@
 "Calculates the predicted mean response curve for any k and for k = 0..3"
 
 import pickle
+import argparse
 import numpy as np
 from bdata import NTRIALS
-from mpl import mpl
-from bfit_samples import get_samples, get_random_params
+from mpl_backends import mean_curve
+from bfit_samples import get_samples, HYPERPARAMS, random_params
+from sample_arrays import hyperparams, select_draws
+from seeding import add_seed_argument, root_seed, generator, native_seed
+from mc_runner import (
+    run, checkpoint_path, clear_checkpoints, add_processes_argument)
 
 REPS = 1000000
 KMAXCURVE = 3
 MEAN_RESP_CURVE_FN = 'mpl_meanresp_curve.pickle'
 KSPEED_CURVES_FN = 'mpl_kspeed_curves.pickle'
 
+def sum_resp_chunk(first, n, hparams, seed, key, ntrials, p_majority, k=None):
+    """
+    Sums the response curves of a chunk of simulated agents.
+
+    This is a task for mc_runner.run. Each agent's parameters are drawn from a
+    random posterior draw.
+
+    Keyword parameters:
+    first -- index of the chunk's first agent
+    n -- number of agents in the chunk
+    hparams -- HyperParams of the posterior draws
+    seed -- root random seed
+    key -- key of the simulation's random streams (a tuple)
+    ntrials -- number of trials
+    p_majority -- probability of the majority outcome
+    k -- fixed k for all agents (default: k drawn from the samples)
+    """
+    rng = generator(seed, *key, 0, first)
+    draws = rng.integers(0, len(hparams.nu), n)
+    ks, As, rhos, thetas = (
+        p.ravel() for p in random_params(select_draws(hparams, draws), rng=rng))
+    if k is not None:
+        ks[:] = k
+    return mean_curve(
+        n, ntrials, p_majority, ks, As, rhos, thetas,
+        native_seed(seed, *key, 1), first)
+
+def sum_resp_curve(hparams, seed, k=None, processes=None):
+    """
+    Sums the response curves of REPS simulated agents.
+
+    Keyword parameters:
+    hparams -- HyperParams of the MPL samples
+    seed -- root random seed
+    k -- fixed k for all agents (default: k drawn from the samples)
+    processes -- number of worker processes (default: number of CPUs)
+    """
+    key = (0 if k is None else k + 1,)
+    sum_resp = run(
+        sum_resp_chunk, REPS, (hparams, seed, key, NTRIALS, 0.7, k),
+        processes=processes,
+        checkpoint_fn=checkpoint_path('mpl_meanresp_curve', *key),
+        run_id=(seed, key),
+        label='Curve for k = {}'.format('any' if k is None else k))
+    assert not np.isnan(sum_resp).any()
+    return sum_resp
+
 def main():
     """Creates the mean response curves and saves them to a file."""
-    samples = get_samples()
-    mean_resp = [0 for i in range(NTRIALS)]
-    for _, sample in samples.sample(REPS).iterrows():
-        for k, A, rho, theta in get_random_params(sample):
-            x = list((np.random.rand(NTRIALS) < 0.7).astype(int))
-            for i, p1 in enumerate(mpl(x, k, A, rho, theta)):
-                assert not np.isnan(p1)
-                mean_resp[i] += p1
-    mean_resp = [r/REPS for r in mean_resp]
+    parser = argparse.ArgumentParser(
+        description='Calculates the predicted mean response curves.')
+    add_seed_argument(parser)
+    add_processes_argument(parser)
+    args = parser.parse_args()
+    seed = root_seed(args.seed)
+    hparams = hyperparams(get_samples(HYPERPARAMS))
+    mean_resp = [r/REPS for r in sum_resp_curve(
+        hparams, seed, processes=args.processes)]
     with open(MEAN_RESP_CURVE_FN, 'wb') as outf:
         pickle.dump(mean_resp, outf)
     # Curves for various ks
-    mean_resps = [[0 for i in range(NTRIALS)] for k in range(KMAXCURVE + 1)]
-    for k, mean_resp in enumerate(mean_resps):
-        for _, sample in samples.sample(REPS).iterrows():
-            for _, A, rho, theta in get_random_params(sample):
-                x = list((np.random.rand(NTRIALS) < 0.7).astype(int))
-                for i, p1 in enumerate(mpl(x, k, A, rho, theta)):
-                    assert not np.isnan(p1)
-                    mean_resp[i] += p1
+    mean_resps = [
+        sum_resp_curve(hparams, seed, k, args.processes)
+        for k in range(KMAXCURVE + 1)]
     with open(KSPEED_CURVES_FN, 'wb') as outf:
         for mean_resp in mean_resps:
             mean_resp = [r/REPS for r in mean_resp]
             pickle.dump(mean_resp, outf)
+    clear_checkpoints('mpl_meanresp_curve')
 
 if __name__ == '__main__':
     main()
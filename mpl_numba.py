@@ -0,0 +1,42 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"MPL model kernels compiled with Numba, used by mpl_backends."
+
+import numpy as np
+import numba
+from numba import njit, prange
+import mpl_python
+
+_logits_row = njit(cache=True)(mpl_python.mpl_logits_row)
+mpl_logl_grad = njit(cache=True)(mpl_python.mpl_logl_grad)
+
+@njit(parallel=True, cache=True)
+def _logits(xs, ks, As, rhos, thetas):
+    rs = np.empty(xs.shape)
+    for r in prange(xs.shape[0]):
+        _logits_row(xs[r], ks[r], As[r], rhos[r], thetas[r], rs[r])
+    return rs
+
+def logits(xs, ks, As, rhos, thetas, n_threads=0):
+    """
+    Logits of responding 1 for a batch of agents, one per row of xs.
+
+    n_threads is the number of threads to use (0 = Numba's default).
+    """
+    numba.set_num_threads(
+        min(n_threads, numba.config.NUMBA_NUM_THREADS) if n_threads > 0 else
+        numba.config.NUMBA_NUM_THREADS)
+    return _logits(xs, ks, As, rhos, thetas)
@@ -16,6 +16,7 @@
 "MPL model implementation in Python."
 
 import random
+import numpy as np
 from numpy import exp
 
 # MPL
@@ -48,45 +49,251 @@ def mpl_slow(xs, k, A, rho, theta):
                 eta = ((eta << 1) + x) % num_mem
 
 def mpl(xs, k, A, rho, theta):
-    "Faster MPL implementation"
-    if k == 0:
-        mem = 0
-        for x in xs:
-            f = theta*mem
-            if f > 40:
-                yield 1
-            else:
-                e = exp(f)
-                yield e/(1 + e)
-            mem = rho*A*mem + (2*x - 1)
-    else:
-        num_mem = (1 << k)
-        mem = [0 for i in range(num_mem)]
-        eta = 0
-        for x in xs[:k]:
+    """
+    Faster MPL implementation.
+
+    Memories are only decayed when read: each context stores its memory and
+    the trial it was last updated, so every trial takes O(1) time for any k.
+    """
+    num_mem = (1 << k)
+    mem = {} # Context -> (memory, trial of last update)
+    eta = 0
+    for t, x in enumerate(xs):
+        if t < k:
             eta = (eta << 1) + x
             yield 0.5
-        for x in xs[k:]:
-            f = theta*mem[eta]
-            if f > 40:
-                yield 1
-            else:
-                e = exp(f)
-                yield e/(1 + e)
-            for i, m in enumerate(mem):
-                mem[i] = A*m
-            mem[eta] = rho*mem[eta] + (2*x - 1)
+            continue
+        m, last = mem.get(eta, (0, t))
+        m *= A**(t - last)
+        f = theta*m
+        if f > 40:
+            yield 1
+        else:
+            e = exp(f)
+            yield e/(1 + e)
+        mem[eta] = (rho*A*m + (2*x - 1), t + 1)
+        eta = ((eta << 1) + x) % num_mem
+
+def mpl_batch_logits(xs, ks, As, rhos, thetas):
+    """
+    Vectorized MPL implementation for a batch of agents.
+
+    Returns an (agents x trials) array with the logits of responding 1.
+
+    Keyword parameters:
+    xs -- (agents x trials) array of outcomes, one agent per row
+    ks, As, rhos, thetas -- parameters, one per agent (or scalars)
+
+    All agents advance in lock-step, one trial at a time, with their
+    memories in an (agents x 2^max(k)) matrix. As in mpl, memories are only
+    decayed when read.
+    """
+    xs = np.asarray(xs, dtype=int)
+    R, T = xs.shape
+    ks, As, rhos, thetas = (
+        np.broadcast_to(np.asarray(p, dtype=dtype), (R,))
+        for p, dtype in ((ks, int), (As, float), (rhos, float), (thetas, float)))
+    num_mem = 1 << ks
+    mem = np.zeros((R, num_mem.max()))
+    last = np.zeros((R, num_mem.max()), dtype=int) # Trial of last update
+    rows = np.arange(R)
+    eta = np.zeros(R, dtype=int)
+    rs = np.zeros((R, T))
+    for t in range(T):
+        x = xs[:, t]
+        learn = t >= ks
+        m = mem[rows, eta]*As**(t - last[rows, eta])
+        rs[:, t] = np.where(learn, thetas*m, 0)
+        i, e = rows[learn], eta[learn]
+        mem[i, e] = rhos[learn]*As[learn]*m[learn] + (2*x[learn] - 1)
+        last[i, e] = t + 1
+        eta = (eta << 1) + x
+        eta[learn] &= num_mem[learn] - 1
+    return rs
+
+def mpl_batch(xs, ks, As, rhos, thetas):
+    """
+    Vectorized MPL implementation for a batch of agents.
+
+    Returns an (agents x trials) array of probabilities of responding 1,
+    see mpl_batch_logits.
+    """
+    rs = mpl_batch_logits(xs, ks, As, rhos, thetas)
+    e = exp(np.minimum(rs, 40))
+    return np.where(rs > 40, 1, e/(1 + e))
+
+def mpl_logits_row(xs, k, A, rho, theta, rs):
+    """
+    Writes the logits of responding 1 for the outcomes xs into the array rs.
+
+    Same algorithm as mpl, written with plain loops over arrays so that it
+    can be compiled with Numba (see mpl_numba.py).
+    """
+    num_mem = 1 << k
+    mem = np.zeros(num_mem)
+    last = np.zeros(num_mem, np.int64) # Trial of last update
+    eta = 0
+    for t in range(len(xs)):
+        x = int(xs[t])
+        if t < k:
+            eta = (eta << 1) + x
+            rs[t] = 0
+            continue
+        m = mem[eta]*A**(t - last[eta])
+        rs[t] = theta*m
+        mem[eta] = rho*A*m + (2*x - 1)
+        last[eta] = t + 1
+        eta = ((eta << 1) + x) % num_mem
+
+def mpl_logl_grad(xs, ys, ini, end, k, A, rho, theta):
+    """
+    Log-likelihood of the responses ys in trials ini..end-1 and its gradient.
+
+    Returns (ll, dll/dA, dll/drho, dll/dtheta). The derivatives of the memory
+    cells are carried forward alongside the memory update. Written with plain
+    loops over arrays so that it can be compiled with Numba.
+    """
+    num_mem = 1 << k
+    mem = np.zeros(num_mem)
+    mem_A = np.zeros(num_mem)
+    mem_rho = np.zeros(num_mem)
+    last = np.zeros(num_mem, np.int64)
+    eta = 0
+    ll, g_A, g_rho, g_theta = 0., 0., 0., 0.
+    for t in range(end):
+        x = int(xs[t])
+        if t < k:
+            eta = (eta << 1) + x
+            m, m_A, m_rho = 0., 0., 0.
+        else:
+            n = t - last[eta]
+            p = A**n
+            m = mem[eta]*p
+            m_A = mem_A[eta]*p + (mem[eta]*n*A**(n - 1) if n > 0 else 0.)
+            m_rho = mem_rho[eta]*p
+            mem[eta] = rho*A*m + (2*x - 1)
+            mem_A[eta] = rho*(m + A*m_A)
+            mem_rho[eta] = A*(m + rho*m_rho)
+            last[eta] = t + 1
             eta = ((eta << 1) + x) % num_mem
+        if t >= ini:
+            f = theta*m
+            # log p(y) = -log(1 + exp(-f)) if y == 1 else -log(1 + exp(f))
+            g = -f if ys[t] == 1 else f
+            ll -= max(g, 0) + np.log1p(exp(-abs(g)))
+            p1 = 1/(1 + exp(-f)) if f > 0 else exp(f)/(1 + exp(f))
+            dll = ys[t] - p1
+            g_A += dll*theta*m_A
+            g_rho += dll*theta*m_rho
+            g_theta += dll*m
+    return ll, g_A, g_rho, g_theta
 
 def test():
     "Tests the MPL implementations against each other"
+    xs = [[int(random.random() < 0.7) for i in range(300)] for j in range(200)]
+    params = [
+        (random.randint(0, 6), random.random(), random.random(),
+         random.uniform(0, 5)) for j in range(200)]
+    p1s = mpl_batch(xs, *zip(*params))
+    for x, (k, A, rho, theta), r2 in zip(xs, params, p1s):
+        r1 = np.array(list(mpl_slow(x, k, A, rho, theta)))
+        if (np.abs(r1 - r2) >= 1e-10).any():
+            print(r1, r2, x, k, A, rho, theta)
+            raise Exception()
     for _ in range(1000):
         xs = [int(random.random() < 0.7) for i in range(300)]
-        k, A, rho, theta = random.randint(0, 3), random.random(), random.random(), random.uniform(0, 5)
+        k, A, rho, theta = random.randint(0, 6), random.random(), random.random(), random.uniform(0, 5)
         for _, (r1, r2) in enumerate(zip(mpl_slow(xs, k, A, rho, theta), mpl(xs, k, A, rho, theta))):
             if abs(r1 - r2) >= 1e-10:
                 print(r1, r2, xs, k, A, rho, theta)
                 raise Exception()
 
+def test_backends():
+    "Tests the available MPL backends against mpl_slow and each other"
+    import mpl_backends
+    ref = mpl_backends.load_backend('numpy')
+    for name in mpl_backends.available_backends():
+        backend = mpl_backends.load_backend(name)
+        for _ in range(100):
+            xs = [int(random.random() < 0.7) for i in range(300)]
+            ys = [int(random.random() < 0.7) for i in range(300)]
+            k, A, rho, theta = random.randint(0, 6), random.random(), random.random(), random.uniform(0, 5)
+            ini, probk = random.randint(0, 50), np.random.dirichlet(np.ones(6))
+            checks = [
+                (backend['mpl'](xs, k, A, rho, theta), list(mpl_slow(xs, k, A, rho, theta))),
+                (backend['mpl_logl'](xs, ys, ini, 300, k, A, rho, theta),
+                 ref['mpl_logl'](xs, ys, ini, 300, k, A, rho, theta)),
+                (backend['mpl_logl_allk'](xs, ys, ini, 300, 5, A, rho, theta),
+                 [ref['mpl_logl'](xs, ys, ini, 300, k, A, rho, theta) for k in range(6)]),
+                (backend['mpl_logl_mixk'](xs, ys, ini, 300, probk, A, rho, theta),
+                 ref['mpl_logl_mixk'](xs, ys, ini, 300, probk, A, rho, theta)),
+                (np.hstack(backend['mpl_logl_grad'](xs, ys, ini, 300, k, A, rho, theta)),
+                 np.hstack(ref['mpl_logl_grad'](xs, ys, ini, 300, k, A, rho, theta))),
+            ]
+            for r1, r2 in checks:
+                if not np.allclose(r1, r2, rtol=1e-8, atol=1e-10):
+                    print(name, r1, r2, xs, ys, k, A, rho, theta)
+                    raise Exception()
+        xs = (np.random.random((50, 300)) < 0.7).astype(int)
+        ys = (np.random.random((50, 300)) < 0.7).astype(int)
+        ks, As, rhos = np.random.randint(0, 6, 50), np.random.random(50), np.random.random(50)
+        thetas = np.random.uniform(0, 5, 50)
+        rows = np.random.randint(0, 50, 50)
+        checks = [
+            (backend['mpl_batch'](xs, ks, As, rhos, thetas),
+             ref['mpl_batch'](xs, ks, As, rhos, thetas)),
+            (backend['simulate_batch'](xs, ks, As, rhos, thetas, 1)[0],
+             ref['mpl_batch'](xs, ks, As, rhos, thetas)),
+            (backend['mpl_logl_batch'](xs, ys, ks, As, rhos, thetas, 0, rows),
+             ref['mpl_logl_batch'](xs, ys, ks, As, rhos, thetas, 0, rows)),
+            (backend['mpl_logl_allk_batch'](xs, ys, 5, As, rhos, thetas, 0, rows),
+             ref['mpl_logl_allk_batch'](xs, ys, 5, As, rhos, thetas, 0, rows)),
+        ]
+        for r1, r2 in checks:
+            if not np.allclose(r1, r2, rtol=1e-8, atol=1e-10):
+                print(name, r1, r2)
+                raise Exception()
+        # Different backends draw different outcomes, so compare the means
+        curve1 = backend['mean_curve'](20000, 300, 0.7, ks, As, rhos, thetas, 1)
+        curve2 = ref['mean_curve'](20000, 300, 0.7, ks, As, rhos, thetas, 2)
+        if abs(np.mean(curve1[-100:]) - np.mean(curve2[-100:]))/20000 > 0.01:
+            print(name, curve1/20000, curve2/20000)
+            raise Exception()
+
+def test_k_checks():
+    "Tests that the C++ backend rejects ks out of range"
+    import mpl_backends
+    if 'c' not in mpl_backends.available_backends():
+        return
+    backend = mpl_backends.load_backend('c')
+    xs = [int(random.random() < 0.7) for i in range(300)]
+    ys = [int(random.random() < 0.7) for i in range(300)]
+    batch_xs, batch_ys = np.array([xs]*2), np.array([ys]*2)
+    for k in (-3, -1, 31, 40, 301, 1 << 40):
+        calls = [
+            lambda: backend['mpl'](xs, k, 0.5, 0.5, 1),
+            lambda: backend['mpl_logl'](xs, ys, 0, 300, k, 0.5, 0.5, 1),
+            lambda: backend['mpl_logl_allk'](xs, ys, 0, 300, k, 0.5, 0.5, 1),
+            lambda: backend['mpl_logl_grad'](xs, ys, 0, 300, k, 0.5, 0.5, 1),
+            lambda: backend['mpl_batch'](batch_xs, [0, k], 0.5, 0.5, 1),
+            lambda: backend['mpl_logl_batch'](
+                batch_xs, batch_ys, [0, k], 0.5, 0.5, 1),
+            lambda: backend['mpl_logl_allk_batch'](
+                batch_xs, batch_ys, k, 0.5, 0.5, 1),
+            lambda: backend['mean_curve'](10, 300, 0.7, [0, k], 0.5, 0.5, 1, 1),
+        ]
+        if 0 <= k < 1000:
+            calls.append(lambda: backend['mpl_logl_mixk'](
+                xs, ys, 0, 300, np.ones(k + 1)/(k + 1), 0.5, 0.5, 1))
+        for call in calls:
+            try:
+                call()
+            except ValueError:
+                continue
+            print(k, call)
+            raise Exception()
+
 if __name__ == '__main__':
     test()
+    test_backends()
+    test_k_checks()
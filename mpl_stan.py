@@ -19,24 +19,94 @@ import os
 import pickle
 import sys
 import argparse
-import pystan
-from bdata import bdata, N, NTRIALS
+import hashlib
+import subprocess
+import sysconfig
+import bdata
 
 SFN = 'mpl_samples_{:04d}'
 KMAX = 5
+# Directory of the compiled model cache, shared by all checkouts
+STAN_CACHE_DIR = os.environ.get('STAN_MODEL_CACHE', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'mpl-stan-models'))
+# Compiler arguments for within-chain threading (see get_mpl_model)
+THREADS_COMPILE_ARGS = ['-pthread', '-DSTAN_THREADS']
 
-def get_stan_model(textfn, binfn):
-    "Compiles a stan model (textfn) and saves it to binary file (binfn)."
-    assert textfn != binfn
-    if os.path.exists(binfn) and \
-        os.path.getmtime(binfn) > os.path.getmtime(textfn):
-        with open(binfn, 'rb') as arq:
-            stan_model = pickle.load(arq)
-    else:
-        stan_model = pystan.StanModel(textfn)
-        with open(binfn, 'wb') as arq:
-            pickle.dump(stan_model, arq)
-    return stan_model
+def _toolchain():
+    """Describes the C++ compiler and Python that compile Stan models."""
+    compiler = sysconfig.get_config_var('CXX') or 'c++'
+    try:
+        version = subprocess.run(
+            compiler.split() + ['--version'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout.decode(errors='replace')
+    except OSError:
+        version = ''
+    return '\n'.join([compiler, version, sys.version])
+
+def stan_model_key(textfn, extra_compile_args=None):
+    """
+    Cache key of a compiled Stan model.
+
+    A SHA-256 hash of the Stan source, the PyStan version, the compiler, and
+    the extra compiler arguments.
+    """
+    import pystan
+    digest = hashlib.sha256()
+    with open(textfn, 'rb') as inf:
+        digest.update(inf.read())
+    for part in (pystan.__version__, _toolchain(), repr(extra_compile_args)):
+        digest.update(b'\0' + part.encode())
+    return digest.hexdigest()
+
+def get_stan_model(textfn, extra_compile_args=None):
+    """
+    Returns a compiled Stan model, compiling it only if not in the cache.
+
+    The compiled models are pickled in STAN_CACHE_DIR (set it with the
+    STAN_MODEL_CACHE environment variable) under their stan_model_key. A
+    model is compiled under a file lock, so processes that need the same
+    model at the same time compile it once.
+
+    Keyword parameters:
+    textfn -- Stan source file
+    extra_compile_args -- extra C++ compiler arguments (default: none)
+    """
+    import fcntl
+    import pystan
+    os.makedirs(STAN_CACHE_DIR, exist_ok=True)
+    binfn = os.path.join(
+        STAN_CACHE_DIR, stan_model_key(textfn, extra_compile_args) + '.pkl')
+    if not os.path.exists(binfn):
+        with open(binfn[:-4] + '.lock', 'w') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            # Another process may have compiled the model meanwhile
+            if not os.path.exists(binfn):
+                print('Compiling {} ...'.format(textfn))
+                sys.stdout.flush()
+                stan_model = pystan.StanModel(
+                    textfn, extra_compile_args=extra_compile_args)
+                tmp_fn = '{}.{}.tmp'.format(binfn, os.getpid())
+                with open(tmp_fn, 'wb') as arq:
+                    pickle.dump(stan_model, arq)
+                os.replace(tmp_fn, binfn)
+                return stan_model
+    with open(binfn, 'rb') as arq:
+        return pickle.load(arq)
+
+def get_mpl_model(threads_per_chain=1):
+    """
+    Returns the compiled hierarchical MPL model.
+
+    With more than one thread per chain, the variant in model-mpl-mr.stan is
+    used, which evaluates the participants' likelihoods in parallel with
+    map_rect, compiled with threading, and STAN_NUM_THREADS is set to the
+    number of threads. It gives the same posterior as model-mpl.stan.
+    """
+    if threads_per_chain <= 1:
+        return get_stan_model('model-mpl.stan')
+    os.environ['STAN_NUM_THREADS'] = str(threads_per_chain)
+    return get_stan_model('model-mpl-mr.stan', THREADS_COMPILE_ARGS)
 
 def main():
     "Fits the MPL model to the data using Stan."
@@ -53,6 +123,9 @@ def main():
     parser.add_argument(
         '--thin', help='the period for saving samples (default 1)', type=int,
         default=1)
+    parser.add_argument(
+        '--threads-per-chain', help='threads evaluating the likelihood of '
+        'each chain (default 1)', type=int, default=1)
     args = parser.parse_args()
     chains = args.chains
     if chains < 1:
@@ -75,14 +148,9 @@ def main():
             os.rename(sfn + '_{}.csv'.format(chain), sfn + '_{}.csv'.format(file_num))
     sfn = sfn + '.csv'
     # Sample
-    mpl_stan = get_stan_model('model-mpl.stan', 'model-mpl')
-    model_dat = {
-        'kmaxp1': KMAX + 1,
-        'T': NTRIALS,
-        'N': N,
-        'x': [x for x, y in bdata],
-        'y': [y for x, y in bdata],
-    }
+    mpl_stan = get_mpl_model(args.threads_per_chain)
+    model_dat = bdata.stan_data(bdata.bdata)
+    model_dat['kmaxp1'] = KMAX + 1
     fit = mpl_stan.sampling(
         data=model_dat, iter=args.iter, warmup=args.warmup, chains=chains,
         thin=args.thin, refresh=10, sample_file=sfn)
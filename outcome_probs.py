@@ -17,39 +17,52 @@
 
 import pickle
 import os
-import numpy as np
-from mpl import mpl
-from bfit_samples import get_samples, get_random_params
+import argparse
+from bfit_samples import get_samples, HYPERPARAMS
+from sample_arrays import hyperparams
+from seeding import add_seed_argument, root_seed
+from mc_runner import (
+    run, checkpoint_path, clear_checkpoints, add_processes_argument)
+from mpl_meanresp_curve import sum_resp_chunk
 
 NTRIALS = 1000
 PROBS = (0.5, 0.6, 0.7, 0.8, 0.9, 1)
 OUTCOME_PROBS_FN = 'outcome_probs.pickle'
 
+def sum_resp(hparams, reps, prob, seed, key, processes):
+    "Sums the response curves of reps agents for majority outcome prob"
+    return run(
+        sum_resp_chunk, reps, (hparams, seed, key, NTRIALS, prob),
+        processes=processes,
+        checkpoint_fn=checkpoint_path('outcome_probs', *key),
+        run_id=(seed, key, prob), label='p = {}'.format(prob))
+
 def main():
     "Calculates the mean response curves and mean responses for each p"
-    samples = get_samples()
+    parser = argparse.ArgumentParser(
+        description='Calculates the mean response for different probabilities '
+        'of the majority outcome.')
+    add_seed_argument(parser)
+    add_processes_argument(parser)
+    args = parser.parse_args()
+    seed = root_seed(args.seed)
+    hparams = hyperparams(get_samples(HYPERPARAMS))
     reps = 1000000
     if not os.path.exists(OUTCOME_PROBS_FN):
+        # Curves for various ps
+        mean_resps = [
+            sum_resp(hparams, reps, prob, seed, (0, i), args.processes)/reps
+            for i, prob in enumerate(PROBS)]
         with open(OUTCOME_PROBS_FN, 'wb') as outf:
-            for prob in PROBS:
-                # Curves for various ps
-                mean_resp = [0 for i in range(NTRIALS)]
-                for _, sample in samples.sample(reps).iterrows():
-                    for k, A, rho, theta in get_random_params(sample):
-                        x = list((np.random.rand(NTRIALS) < prob).astype(int))
-                        for i, p1 in enumerate(mpl(x, k, A, rho, theta)):
-                            mean_resp[i] += p1
-                mean_resp = [r/reps for r in mean_resp]
-                pickle.dump(mean_resp, outf)
+            for mean_resp in mean_resps:
+                pickle.dump(list(mean_resp), outf)
     reps = 100000
-    for prob in PROBS:
-        mean_resp = 0
-        for _, sample in samples.sample(reps).iterrows():
-            for k, A, rho, theta in get_random_params(sample):
-                x = list((np.random.rand(NTRIALS) < prob).astype(int))
-                mean_resp += list(mpl(x, k, A, rho, theta))[-1]
+    for i, prob in enumerate(PROBS):
+        mean_resp = sum_resp(
+            hparams, reps, prob, seed, (1, i), args.processes)[-1]
         mean_resp /= reps
         print(prob, mean_resp)
+    clear_checkpoints('outcome_probs')
 
 if __name__ == '__main__':
     main()
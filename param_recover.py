@@ -15,13 +15,14 @@
 
 "Parameter recovery for individual simulated agents."
 
-import random
+import argparse
 import numpy as np
 from scipy import stats
 from scipy import interpolate
-from mpl import mpl
+from mpl_backends import mpl
 from bdata import NTRIALS
 from mpl_stan import get_stan_model, KMAX
+from seeding import add_seed_argument, root_seed, generator
 
 PARAM_RECOVERY_FN = 'param_recover_results.csv'
 
@@ -77,7 +78,11 @@ def product_uniform_prior(x):
 
 def main():
     """Performs parameter recovery for simulated MPL agents and saves result to CSV file."""
-    mpl_stan = get_stan_model('model-mpl-ind.stan', 'model-mpl-ind')
+    parser = argparse.ArgumentParser(
+        description='Performs parameter recovery for simulated MPL agents.')
+    add_seed_argument(parser)
+    rng = generator(root_seed(parser.parse_args().seed))
+    mpl_stan = get_stan_model('model-mpl-ind.stan')
     k_prior = [1/(KMAX + 1) for k in range(KMAX + 1)]
     A_prior = get_uniform_prior(0, 1)
     rho_prior = get_uniform_prior(0, 1)
@@ -87,12 +92,13 @@ def main():
         outf.write('k,A,rho,theta,kld_k,kld_A,kld_rho,kld_theta,'\
             'kld_Axrho\n')
         for _ in range(10000):
-            k = random.randint(0, KMAX)
-            A = random.random()
-            rho = random.random()
-            theta = random.uniform(0, 5)
-            x = list((np.random.random(NTRIALS) < 0.7).astype(int))
-            y = [int(random.random() < p1) for p1 in mpl(x, k, A, rho, theta)]
+            k = int(rng.integers(0, KMAX + 1))
+            A = rng.random()
+            rho = rng.random()
+            theta = rng.uniform(0, 5)
+            x = list((rng.random(NTRIALS) < 0.7).astype(int))
+            y = list((rng.random(NTRIALS) < mpl(x, k, A, rho, theta)).astype(
+                int))
             model_dat = {
                 'kmaxp1': KMAX + 1,
                 'T': NTRIALS,
@@ -16,11 +16,16 @@
 "Calculates the mean response curve for different MPL parameter sets."
 
 import pickle
+import argparse
 import numpy as np
-from bfit_samples import get_samples, get_random_params
-from mpl import mpl
+from bfit_samples import get_samples, HYPERPARAMS, random_params
+from sample_arrays import hyperparams, select_draws
+from mpl_backends import mpl_batch
 from bdata import NTRIALS
 from predictive_mean_resp import get_mr
+from seeding import add_seed_argument, root_seed, generator
+from mc_runner import (
+    run, checkpoint_path, clear_checkpoints, add_processes_argument)
 
 TESTS = (
     lambda k, A, rho, theta: (k, A, rho, theta),
@@ -34,20 +39,45 @@ TESTS = (
 )
 PARAMS_PERFORMANCE_FN = 'params_performance.pickle'
 REPS = 1000000
+BATCH = 10000
+
+def sum_resp_chunk(first, n, t, hparams, seed):
+    """
+    Sums the response probabilities of a chunk of agents for test t.
+
+    This is a task for mc_runner.run (see mpl_meanresp_curve.sum_resp_chunk).
+    """
+    rng = generator(seed, t, first)
+    draws = rng.integers(0, len(hparams.nu), n)
+    ks, As, rhos, thetas = np.broadcast_arrays(*TESTS[t](*(
+        p.ravel()
+        for p in random_params(select_draws(hparams, draws), rng=rng))))
+    xs = (rng.random((n, NTRIALS)) < 0.7).astype(np.int8)
+    return mpl_batch(xs, ks, As, rhos, thetas).sum(axis=0)
 
 def main():
     """Calculates and saves the mean response curves."""
-    samples = get_samples()
+    parser = argparse.ArgumentParser(
+        description='Calculates the mean response curve for different MPL '
+        'parameter sets.')
+    add_seed_argument(parser)
+    add_processes_argument(parser)
+    args = parser.parse_args()
+    seed = root_seed(args.seed)
+    hparams = hyperparams(get_samples(HYPERPARAMS))
+    mean_resps = []
+    for t in range(len(TESTS)):
+        mean_resp = run(
+            sum_resp_chunk, REPS, (t, hparams, seed), BATCH, args.processes,
+            checkpoint_path('params_performance', t), seed,
+            'Test {}'.format(t))
+        mean_resp /= REPS
+        print(get_mr(mean_resp))
+        mean_resps.append(mean_resp)
     with open(PARAMS_PERFORMANCE_FN, 'wb') as outf:
-        for _, test in enumerate(TESTS):
-            mean_resp = np.zeros(NTRIALS)
-            for _, sample in samples.sample(REPS).iterrows():
-                for k, A, rho, theta in get_random_params(sample):
-                    xs = list((np.random.random(NTRIALS) < 0.7).astype(int))
-                    mean_resp += np.array(mpl(xs, *test(k, A, rho, theta)))
-            mean_resp /= REPS
+        for mean_resp in mean_resps:
             pickle.dump(mean_resp, outf)
-            print(get_mr(mean_resp))
+    clear_checkpoints('params_performance')
 
 if __name__ == '__main__':
     main()
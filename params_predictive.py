@@ -16,19 +16,25 @@
 "Calculates the predictive distribution of MPL parameters."
 
 import pickle
-from bfit_samples import get_samples, get_random_params, get_ks_hparams
+import argparse
+from bfit_samples import (
+    get_samples, HYPERPARAMS, random_params, get_ks_hparams)
+from sample_arrays import hyperparams
+from seeding import add_seed_argument, root_seed, generator
 
 PARAMS_PREDICTIVE_FN = 'params_predictive.pickle'
 
 def main():
     "Generates and saves random MPL parameters from the posterior distribution."
-    samples = get_samples()
-    As, rhos, thetas = [], [], []
-    for _, sample in samples.sample(100000).iterrows():
-        for _, A, rho, theta in get_random_params(sample):
-            As.append(float(A))
-            rhos.append(float(rho))
-            thetas.append(float(theta))
+    parser = argparse.ArgumentParser(
+        description='Generates random MPL parameters from the posterior '
+        'distribution.')
+    add_seed_argument(parser)
+    rng = generator(root_seed(parser.parse_args().seed))
+    samples = get_samples(HYPERPARAMS)
+    _, As, rhos, thetas = (
+        p.ravel().tolist() for p in random_params(
+            hyperparams(samples.sample(100000, random_state=rng)), rng=rng))
     with open('params_predictive.pickle', 'wb') as outf:
         probk = get_ks_hparams(samples)
         pickle.dump([p.mean() for p in probk], outf)
@@ -20,8 +20,11 @@ This illustrates how k, A, rho, and theta affect performance differently.
 """
 
 import pickle
-from mpl import mpl
-import numpy as np
+import argparse
+from mpl_backends import mean_curve
+from seeding import add_seed_argument, root_seed, native_seed
+from mc_runner import (
+    run, checkpoint_path, clear_checkpoints, add_processes_argument)
 
 REPS = 1000000
 KMAX_PATSEARCH = 5
@@ -34,18 +37,33 @@ PARAM_SETS = (
 )
 PATSEARCH_CURVES_FN = 'mpl_pattern_search_curves.pickle'
 
+def sum_resp_chunk(first, n, k, A, rho, theta, seed):
+    "Sums the response curves of a chunk of agents (a task for mc_runner.run)."
+    return mean_curve(n, NTRIALS, 0.7, k, A, rho, theta, seed, first)
+
 def main():
     "Calculates and saves the mean response curves."
+    parser = argparse.ArgumentParser(
+        description='Calculates the mean response curves for different MPL '
+        'parameter sets.')
+    add_seed_argument(parser)
+    add_processes_argument(parser)
+    args = parser.parse_args()
+    seed = root_seed(args.seed)
+    mean_resps = []
+    for i, (A, rho, theta) in enumerate(PARAM_SETS):
+        for k in range(KMAX_PATSEARCH + 1):
+            mean_resp = run(
+                sum_resp_chunk, REPS,
+                (k, A, rho, theta, native_seed(seed, i, k)),
+                processes=args.processes,
+                checkpoint_fn=checkpoint_path('pattern_search', i, k),
+                run_id=seed, label='Parameter set {}, k = {}'.format(i, k))
+            mean_resps.append([r/REPS for r in mean_resp])
     with open(PATSEARCH_CURVES_FN, 'wb') as outf:
-        for A, rho, theta in PARAM_SETS:
-            for k in range(KMAX_PATSEARCH + 1):
-                mean_resp = [0 for i in range(NTRIALS)]
-                for _ in range(REPS):
-                    x = list((np.random.rand(NTRIALS) < 0.7).astype(int))
-                    for i, p1 in enumerate(mpl(x, k, A, rho, theta)):
-                        mean_resp[i] += p1
-                mean_resp = [r/REPS for r in mean_resp]
-                pickle.dump(mean_resp, outf)
+        for mean_resp in mean_resps:
+            pickle.dump(mean_resp, outf)
+    clear_checkpoints('pattern_search')
 
 if __name__ == '__main__':
     main()
@@ -371,7 +371,9 @@ if __name__ == '__main__':
     axes.xaxis.set_ticks_position('bottom')
     axes.yaxis.set_ticks_position('left')
     xx = np.arange(1, NTRIALS + 1)
-    yy = [np.mean([y[t] for x, y in bdata]) for t in range(NTRIALS)]
+    yy = [
+        np.mean([y[t] for x, y in bdata if t < len(y)])
+        for t in range(NTRIALS)]
     plt.xlabel('Trial')
     plt.ylabel('Mean response')
     plt.ylim(0, 1)
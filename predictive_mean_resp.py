@@ -16,22 +16,24 @@
 """Calculates the predictive mean response for a participant or sample."""
 
 import pickle
-import random
+import argparse
 import numpy as np
-from mpl import mpl
-from bfit_samples import get_samples, get_random_params
+from mpl_backends import mpl
+from bfit_samples import get_samples, HYPERPARAMS, get_random_params
+from sample_arrays import iter_hyperparams
 from bdata import N, bdata, NTRIALS
 import pandas as pd
 from hyperparams_estimates import f2s
 from bayesian import hpd
+from seeding import add_seed_argument, root_seed, generator
 
 def get_mr(ys):
     "Calculates the mean response in the last 100 trials."
     return np.mean(ys[-100:])
 
-def get_mpl_mr(xs, k, A, rho, theta):
+def get_mpl_mr(xs, k, A, rho, theta, rng=np.random):
     "Calculates the mean response of an MPL agent with the given parameters."
-    ys = [int(random.random() < p1) for p1 in mpl(xs, k, A, rho, theta)]
+    ys = rng.random(len(xs)) < mpl(xs, k, A, rho, theta)
     return get_mr(ys)
 
 KMAX_MEAN_RESP = 3
@@ -39,18 +41,22 @@ REPS = 10000
 
 def main():
     "Calculates the predicted mean responses."
+    parser = argparse.ArgumentParser(
+        description='Calculates the predicted mean responses.')
+    add_seed_argument(parser)
+    rng = generator(root_seed(parser.parse_args().seed))
     truemr = np.mean([get_mr(ys) for xs, ys in bdata])
-    samples = get_samples()
+    samples = get_samples(HYPERPARAMS)
 
     # Predicted mean response for a new participant with a specific k
     with open('mr_dist_by_k.pickle', 'wb') as outf:
         for k in range(KMAX_MEAN_RESP + 1):
             mrs = []
 
-            for _, sample in samples.iterrows():
-                for _, A, rho, theta in get_random_params(sample):
-                    xs = list((np.random.random(NTRIALS) < 0.7).astype(int))
-                    mean_resp = get_mpl_mr(xs, k, A, rho, theta)
+            for sample in iter_hyperparams(samples):
+                for _, A, rho, theta in get_random_params(sample, rng=rng):
+                    xs = (rng.random(NTRIALS) < 0.7).astype(int)
+                    mean_resp = get_mpl_mr(xs, k, A, rho, theta, rng)
                     mrs.append(mean_resp)
             mrs = pd.Series(mrs)
             print(
@@ -62,10 +68,10 @@ def main():
     # Predicted mean response for a new participant
     mrs = []
 
-    for _, sample in samples.iterrows():
-        for k, A, rho, theta in get_random_params(sample):
-            xs = list((np.random.random(NTRIALS) < 0.7).astype(int))
-            mean_resp = get_mpl_mr(xs, k, A, rho, theta)
+    for sample in iter_hyperparams(samples):
+        for k, A, rho, theta in get_random_params(sample, rng=rng):
+            xs = (rng.random(NTRIALS) < 0.7).astype(int)
+            mean_resp = get_mpl_mr(xs, k, A, rho, theta, rng)
             mrs.append(mean_resp)
 
     mrs = pd.Series(mrs)
@@ -79,10 +85,10 @@ def main():
 
     # Predicted mean response for 84 new participants
     mrs1 = []
-    for _, sample in samples.sample(REPS).iterrows():
+    for sample in iter_hyperparams(samples.sample(REPS, random_state=rng)):
         mr1 = 0
-        for (x, _), (k, A, rho, theta) in zip(bdata, get_random_params(sample, N)):
-            mean_resp = get_mpl_mr(x, k, A, rho, theta)
+        for (x, _), (k, A, rho, theta) in zip(bdata, get_random_params(sample, N, rng)):
+            mean_resp = get_mpl_mr(x, k, A, rho, theta, rng)
             mr1 += mean_resp
         mr1 /= N
         mrs1.append(mr1)
@@ -18,7 +18,7 @@
 import os
 import sys
 import argparse
-from bdata import bdata, N, NTRIALS
+from bdata import bdata, stan_data
 from mpl_stan import get_stan_model
 
 SFN = 'pvl_samples_{:04d}.csv'
@@ -41,13 +41,8 @@ def fit_pvl_stan():
         sys.exit(0)
 
     # Sample
-    stan_model = get_stan_model('model-pvl.stan', 'model-pvl')
-    model_dat = {
-        'T': NTRIALS,
-        'N': N,
-        'x': [x for x, y in bdata],
-        'y': [y for x, y in bdata],
-    }
+    stan_model = get_stan_model('model-pvl.stan')
+    model_dat = stan_data(bdata)
     sample_file_name = SFN.format(args.warmup)
     sample_file_name = os.path.join(os.getcwd(), sample_file_name)
     fit = stan_model.sampling(
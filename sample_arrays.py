@@ -0,0 +1,94 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Converts Stan samples to NumPy arrays.
+
+The samples may be a Pandas dataframe, a dictionary of columns (as returned by
+sample_store.load_columns), or a single sample (a Pandas series). Stan names
+the columns of a vector or matrix parameter like sigma.1.2; these are gathered
+into one array with a leading sample dimension of size S.
+"""
+
+import collections
+import numpy as np
+from mpl_stan import KMAX
+
+HyperParams = collections.namedtuple('HyperParams', 'probk mu sigma nu')
+HyperParams.__doc__ = """\
+MPL hyperparameters.
+
+probk -- S x (KMAX + 1) probabilities of each k
+mu -- S x 3 location of the (logit A, logit rho, log theta) distribution
+sigma -- S x 3 x 3 scale matrix of that distribution
+nu -- S degrees of freedom of that distribution
+"""
+
+def param_array(samples, name, shape=()):
+    """
+    Gathers the columns of a Stan parameter into an array.
+
+    Keyword parameters:
+    samples -- samples (see module docstring)
+    name -- parameter name
+    shape -- shape of the parameter, e.g. (3, 3) for sigma
+
+    Returns an S x shape float64 array.
+    """
+    if not shape:
+        return np.atleast_1d(np.asarray(samples[name], float))
+    columns = [
+        np.atleast_1d(np.asarray(samples['{}.{}'.format(
+            name, '.'.join(str(i + 1) for i in index))], float))
+        for index in np.ndindex(*shape)]
+    return np.stack(columns, axis=-1).reshape((-1,) + tuple(shape))
+
+def hyperparams(samples, kmax=KMAX, nparams=3):
+    """Returns the hyperparameters in samples as a HyperParams tuple."""
+    return HyperParams(
+        param_array(samples, 'probk', (kmax + 1,)) if kmax is not None else
+        None,
+        param_array(samples, 'mu', (nparams,)),
+        param_array(samples, 'sigma', (nparams, nparams)),
+        param_array(samples, 'nu'))
+
+def subject_params(samples, subjs, names=('A', 'rho', 'theta')):
+    """
+    Returns some participants' parameters in samples.
+
+    subjs are participant numbers (indices of bdata), which Stan numbers from
+    1. Returns a list of S x len(subjs) arrays, one per parameter name.
+    """
+    return [
+        np.stack([
+            param_array(samples, '{}.{}'.format(name, subj + 1))
+            for subj in subjs], axis=-1)
+        for name in names]
+
+def select_draws(hparams, index):
+    """Returns the draws of a HyperParams tuple selected by index."""
+    return HyperParams(*(None if a is None else a[index] for a in hparams))
+
+def iter_hyperparams(samples, kmax=KMAX, nparams=3):
+    """
+    Iterates over the draws in samples.
+
+    The samples are converted once with hyperparams; yields a HyperParams
+    tuple of a single draw (probk, mu, and sigma without the sample
+    dimension, nu a scalar) for each draw.
+    """
+    hparams = hyperparams(samples, kmax, nparams)
+    for s in range(len(hparams.nu)):
+        yield select_draws(hparams, s)
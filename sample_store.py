@@ -0,0 +1,242 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Columnar store for posterior samples.
+
+A store is a directory with one binary file per column, holding the column's
+values as little-endian float64, and a meta.json file with the column names
+and the number of rows. Samples are appended to the files, so each draw is
+written only once, and columns are loaded by memory-mapping their files, so
+loading only the needed columns is fast.
+
+Stan sample files can be ingested while Stan is still writing them: the
+metadata records how much of each file has been read, so each call to
+ingest_csv appends only the new draws. Writers hold an exclusive lock on the
+file path + '.lock' next to the store, so several processes can ingest the
+same files into a store at the same time.
+"""
+
+import os
+import io
+import json
+import hashlib
+import contextlib
+import numpy as np
+
+META_FN = 'meta.json'
+DTYPE = np.dtype('<f8')
+BLOCK_SIZE = 1 << 26 # Bytes read at a time from a Stan sample file
+HEAD_SIZE = 1 << 16 # Bytes of a Stan sample file hashed to recognize it
+
+def _column_fn(path, column):
+    """File name of a column in a store."""
+    return os.path.join(path, column + '.f8')
+
+def read_meta(path):
+    """
+    Reads the metadata of a store.
+
+    Returns a dictionary with the column names (columns) and the number of
+    rows (rows), or None if the store does not exist.
+    """
+    try:
+        with open(os.path.join(path, META_FN)) as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return None
+
+def _write_meta(path, meta):
+    """Replaces the metadata of a store atomically."""
+    tmp_fn = os.path.join(path, '{}.{}.tmp'.format(META_FN, os.getpid()))
+    with open(tmp_fn, 'w') as outf:
+        json.dump(meta, outf)
+    os.replace(tmp_fn, os.path.join(path, META_FN))
+
+@contextlib.contextmanager
+def locked(path):
+    """Holds the exclusive lock on a store."""
+    import fcntl
+    lock_fn = os.path.normpath(path) + '.lock'
+    with open(lock_fn, 'w') as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        yield
+
+def append_samples(path, samples, sources=None):
+    """
+    Appends samples to a store, creating it if it does not exist.
+
+    Keyword parameters:
+    path -- the store directory
+    samples -- Pandas dataframe (or dictionary of equal-length arrays) with
+        the samples; it must have the same columns as the store
+    sources -- if not None, the state of the sample files read so far, which
+        is saved with the metadata (see ingest_csv)
+
+    Returns the number of rows in the store.
+    """
+    with locked(path):
+        return _append_samples(path, samples, sources)
+
+def _append_samples(path, samples, sources):
+    """append_samples for a caller that holds the store's lock."""
+    columns = list(samples.keys())
+    meta = read_meta(path)
+    if meta is None:
+        os.makedirs(path, exist_ok=True)
+        meta = {'columns': columns, 'rows': 0}
+    elif sorted(columns) != sorted(meta['columns']):
+        raise ValueError('Samples do not have the columns of store {}'.format(
+            path))
+    nrows = None
+    for column in meta['columns']:
+        values = np.asarray(samples[column], DTYPE)
+        if nrows is None:
+            nrows = len(values)
+        elif len(values) != nrows:
+            raise ValueError('Columns have different lengths')
+        with open(_column_fn(path, column), 'ab') as outf:
+            # Discard data written after the last complete append
+            outf.truncate(meta['rows']*DTYPE.itemsize)
+            outf.write(values.tobytes())
+    # The rows are only visible to readers after the metadata is updated
+    meta['rows'] += nrows or 0
+    if sources is not None:
+        meta['sources'] = sources
+    _write_meta(path, meta)
+    return meta['rows']
+
+def select_columns(columns, prefixes):
+    """
+    Selects columns by parameter name.
+
+    A prefix such as 'sigma' selects the column sigma and the columns
+    sigma.i.j. If prefixes is None, all columns are selected.
+    """
+    if prefixes is None:
+        return list(columns)
+    return [
+        column for column in columns
+        if any(column == prefix or column.startswith(prefix + '.')
+               for prefix in prefixes)]
+
+def load_columns(path, prefixes=None):
+    """
+    Memory-maps columns of a store.
+
+    Returns a dictionary of read-only arrays, one per column selected by
+    prefixes (see select_columns).
+    """
+    meta = read_meta(path)
+    if meta is None:
+        raise FileNotFoundError('Sample store {} does not exist'.format(path))
+    nrows = meta['rows']
+    return {
+        column: np.memmap(_column_fn(path, column), DTYPE, 'r', 0, (nrows,))
+        if nrows else np.zeros(0, DTYPE)
+        for column in select_columns(meta['columns'], prefixes)}
+
+def load_samples(path, prefixes=None):
+    """Loads columns of a store (see load_columns) as a Pandas dataframe."""
+    import pandas as pd
+    return pd.DataFrame(load_columns(path, prefixes))
+
+def _parse_draws(lines, state):
+    """
+    Parses complete lines of a Stan sample file.
+
+    Comment lines are skipped. The first other line is the header, which
+    sets state['columns']. Returns a Pandas dataframe of the draws.
+    """
+    import pandas as pd
+    if state['columns'] is None:
+        start = 0
+        while start < len(lines):
+            end = lines.index(b'\n', start) + 1
+            line = lines[start:end].strip()
+            start = end
+            if line and not line.startswith(b'#'):
+                state['columns'] = line.decode().split(',')
+                break
+        lines = lines[start:]
+    if state['columns'] is None:
+        return None
+    try:
+        return pd.read_csv(
+            io.BytesIO(lines), comment='#', header=None,
+            names=state['columns'], dtype=DTYPE)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=state['columns'], dtype=DTYPE)
+
+def _head_hash(fd, size):
+    """SHA-256 digest of the first size bytes of a file."""
+    return hashlib.sha256(os.pread(fd, size, 0)).hexdigest()
+
+def ingest_csv(path, csv_fn, warmup, block_size=BLOCK_SIZE):
+    """
+    Appends the new draws in a Stan sample file to a store.
+
+    The file may still be being written. Only complete lines are read, and
+    the first warmup draws are discarded. The files are identified by device
+    and inode, so a file that is renamed is not read again, and by a hash of
+    their first HEAD_SIZE bytes, so a new file that reuses the inode of a
+    deleted file is read from the start.
+
+    Returns the number of draws appended.
+    """
+    with locked(path):
+        return _ingest_csv(path, csv_fn, warmup, block_size)
+
+def _ingest_csv(path, csv_fn, warmup, block_size):
+    """ingest_csv for a caller that holds the store's lock."""
+    meta = read_meta(path) or {}
+    sources = meta.get('sources', {})
+    appended = 0
+    with open(csv_fn, 'rb') as inf:
+        stat = os.fstat(inf.fileno())
+        key = '{}:{}'.format(stat.st_dev, stat.st_ino)
+        state = sources.get(key)
+        # States saved by earlier versions have no head hash
+        if state is not None and (state['offset'] > stat.st_size or (
+                'head' in state and _head_hash(
+                    inf.fileno(), state['head_size']) != state['head'])):
+            state = None
+        if state is None:
+            state = {'offset': 0, 'rows': 0, 'columns': None}
+        state['file'] = csv_fn
+        sources[key] = state
+        inf.seek(state['offset'])
+        buf = b''
+        while True:
+            block = inf.read(block_size)
+            if not block:
+                break
+            buf += block
+            end = buf.rfind(b'\n') + 1
+            if end == 0:
+                continue
+            lines, buf = buf[:end], buf[end:]
+            draws = _parse_draws(lines, state)
+            state['offset'] += len(lines)
+            state['head_size'] = min(state['offset'], HEAD_SIZE)
+            state['head'] = _head_hash(inf.fileno(), state['head_size'])
+            if draws is None:
+                continue
+            skip = max(0, warmup - state['rows'])
+            state['rows'] += len(draws)
+            draws = draws.iloc[skip:]
+            _append_samples(path, draws, sources)
+            appended += len(draws)
+    return appended
@@ -0,0 +1,51 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reproducible random number streams.
+
+All the random numbers of a run are derived from one root seed. A stream is
+identified by the root seed and a key of non-negative integers, e.g.
+(test, chunk), and is independent of the other streams. Since a stream does
+not depend on which process uses it or in which order, work that is split
+into chunks gives the same results however the chunks are run.
+"""
+
+import numpy as np
+
+def seed_sequence(seed, *key):
+    """NumPy SeedSequence of the stream key derived from the root seed."""
+    return np.random.SeedSequence(seed, spawn_key=key)
+
+def generator(seed, *key):
+    """NumPy random generator of the stream key."""
+    return np.random.default_rng(seed_sequence(seed, *key))
+
+def native_seed(seed, *key):
+    """64-bit seed of the stream key, for the MPL backends' batch kernels."""
+    return int(seed_sequence(seed, *key).generate_state(1, np.uint64)[0])
+
+def add_seed_argument(parser):
+    """Adds the --seed option to an argument parser."""
+    parser.add_argument(
+        '--seed', help='root random seed (default: a random seed, which is '
+        'printed)', type=int, default=None)
+
+def root_seed(seed=None):
+    """Returns seed, or a new random root seed (printed) if seed is None."""
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        print('Random seed:', seed)
+    return seed
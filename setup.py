@@ -17,7 +17,10 @@
 
 from distutils.core import setup, Extension
 
-module = Extension('mpl', sources = ['mpl.cpp'])
+module = Extension(
+    'mpl', sources = ['mpl.cpp'],
+    extra_compile_args = ['-std=c++11', '-pthread'],
+    extra_link_args = ['-pthread'])
 setup(
     name = 'MPL',
     version = '1.0',
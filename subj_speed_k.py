@@ -17,15 +17,22 @@
 
 import pickle
 import os
+import argparse
 import statsmodels.api as sm
 from scipy.special import logit
 import numpy as np
 from bfit_samples import get_samples, get_subject_meank
 from bdata import bdata, N, NTRIALS
 from mpl_meanresp_curve import KMAXCURVE, KSPEED_CURVES_FN
+from seeding import add_seed_argument, root_seed, generator
 
 def main():
     "Calculates the mean k and mean responses for each participant."
+    parser = argparse.ArgumentParser(
+        description="Calculates how a participant's estimated k influences "
+        "learning speed.")
+    add_seed_argument(parser)
+    args = parser.parse_args()
     with open(KSPEED_CURVES_FN, 'rb') as inpf:
         mpl_kcurves = [pickle.load(inpf) for k in range(KMAXCURVE + 1)]
     # Determine interval with maximum difference in mean response
@@ -43,7 +50,8 @@ def main():
     print(dif, ini, end)
     if not os.path.exists('mean_k.pickle'):
         samples = get_samples()
-        samples = samples.sample(10000)
+        samples = samples.sample(
+            10000, random_state=generator(root_seed(args.seed)))
         mean_k = [get_subject_meank(samples, i) for i in range(N)]
         with open('mean_k.pickle', 'wb') as outf:
             pickle.dump((ini, end), outf)
@@ -0,0 +1,47 @@
+# Copyright 2017 Carolina Feher da Silva <carolfsu@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Loads MPL samples into the sample store while mpl_stan.py is running.
+
+The analysis scripts can then use the samples drawn so far.
+Run:
+$ python3 tail_samples.py [--interval SECONDS]
+"""
+
+import time
+import argparse
+from bfit_samples import update_samples, SAMPLES_DIR
+from sample_store import read_meta
+
+def main():
+    """Appends new MPL samples to the sample store periodically."""
+    parser = argparse.ArgumentParser(
+        description='Loads MPL samples into the sample store as they are '
+        'drawn.')
+    parser.add_argument(
+        '--interval', help='seconds between updates (default 60)',
+        type=float, default=60)
+    args = parser.parse_args()
+    try:
+        while True:
+            update_samples()
+            print('{} samples in store'.format(read_meta(SAMPLES_DIR)['rows']))
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -15,18 +15,20 @@
 
 """Calculates how the mean response changes with the last minority outcome."""
 
-from bdata import bdata, N, NTRIALS
+from bdata import bdata, N
 import matplotlib.pyplot as plt
 import numpy as np
 import pickle
 import os
-from bfit_samples import get_samples, get_random_params
-from mpl import mpl
-import random
+from bfit_samples import get_samples, HYPERPARAMS, get_random_params
+from sample_arrays import iter_hyperparams
+from mpl_backends import mpl
+import argparse
 from bayesian import hpd
 import pandas as pd
 import sys
 from mpl_stan import get_stan_model
+from seeding import add_seed_argument, root_seed, generator
 
 L = 7
 REPS = 100000
@@ -35,10 +37,10 @@ def calc_wavy_last(x, y, l):
     "Calculates the effect in the last 100 trials of the task."
     c = [[] for i in range(l)]
     n = 1
-    for t in range(0, NTRIALS):
+    for t in range(0, len(x)):
         if t >= 200:
-            c[n].append(y[t])
-            c[0].append(y[t])
+            c[n].append(int(y[t]))
+            c[0].append(int(y[t]))
         if x[t] == 0:
             n = 1
         else:
@@ -53,10 +55,10 @@ def calc_wavy_first(x, y, l):
             break
     n = 1
     assert x[m] == 0
-    for t in range(m + 1, NTRIALS):
+    for t in range(m + 1, len(x)):
         if t < 100:
-            c[n].append(y[t])
-            c[0].append(y[t])
+            c[n].append(int(y[t]))
+            c[0].append(int(y[t]))
         if x[t] == 0:
             n = 1
         else:
@@ -64,10 +66,15 @@ def calc_wavy_first(x, y, l):
     return c
 
 def main():
+    parser = argparse.ArgumentParser(
+        description='Calculates the wavy effect in participants and MPL '
+        'agents.')
+    add_seed_argument(parser)
+    args = parser.parse_args()
     # Participants
     if not os.path.exists('part_wavy.pickle'):
         # Run statistical analysis
-        sm = get_stan_model('model-binomial.stan', 'model-binomial')
+        sm = get_stan_model('model-binomial.stan')
         f1 = []
         f2 = []
         with open('wavy_stanfit.txt', 'w') as of:
@@ -101,14 +108,16 @@ def main():
     
 
     if not os.path.exists('sim_wavy.pickle'):
-        samples = get_samples()
+        samples = get_samples(HYPERPARAMS)
         repf1 = [[] for i in range(L)]
         repf2 = [[] for i in range(L)]
-        for n, s in samples.sample(REPS).iterrows():
+        rng = generator(root_seed(args.seed))
+        for s in iter_hyperparams(samples.sample(REPS, random_state=rng)):
             f1 = [0 for i in range(L)]
             f2 = [0 for i in range(L)]
-            for (x, _), (k, A, rho, t) in zip(bdata, get_random_params(s, N)):
-                y = [int(random.random() < p1) for p1 in mpl(x, k, A, rho, t)]
+            for (x, _), (k, A, rho, t) in zip(
+                    bdata, get_random_params(s, N, rng)):
+                y = (rng.random(len(x)) < mpl(x, k, A, rho, t)).astype(int)
                 c = [np.mean(i) for i in calc_wavy_first(x, y, L)]
                 f1 = [fi + ci for fi, ci in zip(f1, c)]
                 c = [np.mean(i) for i in calc_wavy_last(x, y, L)]
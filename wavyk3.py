@@ -15,12 +15,13 @@
 
 """Simulates MPL k = 3 and calculates how the mean resp. changes after a 0."""
 
-import random
 import pickle
-from mpl import mpl
+import argparse
+from mpl_backends import mpl
 import numpy as np
 from bdata import NTRIALS
 from wavy import calc_wavy_first, calc_wavy_last, L
+from seeding import add_seed_argument, root_seed, generator
 
 A = 1
 RHO = 1
@@ -31,10 +32,15 @@ N = 100000
 
 def main():
     "Runs the simulation and analysis, prints and saves the results."
+    parser = argparse.ArgumentParser(
+        description='Simulates MPL k = 3 and calculates how the mean response '
+        'changes after a 0.')
+    add_seed_argument(parser)
+    rng = generator(root_seed(parser.parse_args().seed))
     results = []
     for _ in range(N):
-        x = list((np.random.rand(NTRIALS) < 0.7).astype(int))
-        y = [random.random() < p1 for p1 in mpl(x, K, A, RHO, THETA)]
+        x = list((rng.random(NTRIALS) < 0.7).astype(int))
+        y = list(rng.random(NTRIALS) < mpl(x, K, A, RHO, THETA))
         cwf_results = [np.mean(i) for i in calc_wavy_first(x, y, L)]
         cwl_results = [np.mean(i) for i in calc_wavy_last(x, y, L)]
         results.append((y, cwf_results, cwl_results))